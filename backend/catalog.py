@@ -0,0 +1,302 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from . import config, image_info, utils
+
+IMAGE_EXTENSIONS = (".webp", ".png", ".jpg", ".jpeg", ".gif", ".bmp")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    created REAL,
+    modified REAL,
+    info TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS images_collection ON images (collection, path);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    added INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_collection ON changes (collection, seq);
+"""
+
+# Clients further behind than this many changes have to reload the listing
+MAX_CHANGES = 10000
+
+local = threading.local()
+
+
+def connect(user: str) -> sqlite3.Connection:
+    # One connection per thread and user, WAL lets the worker pool processes write alongside the server
+    connections = local.__dict__.setdefault("connections", {})
+    db_path = config.get_catalog_path(user)
+    connection = connections.get(db_path)
+    if connection is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        connection = sqlite3.connect(db_path, timeout=30.0, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        connections[db_path] = connection
+    return connection
+
+
+@contextmanager
+def transaction(connection: sqlite3.Connection, mode: str = "IMMEDIATE"):
+    connection.execute(f"BEGIN {mode}")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def log_change(connection: sqlite3.Connection, path: str, added: bool):
+    cursor = connection.execute(
+        "INSERT INTO changes (path, collection, added) VALUES (?, ?, ?)", (path, collection_of(path), int(added))
+    )
+    connection.execute("DELETE FROM changes WHERE seq <= ?", (cursor.lastrowid - MAX_CHANGES,))
+
+
+def collection_of(path: str) -> str:
+    return path.rsplit("/", 1)[0] if "/" in path else ""
+
+
+def make_entry(path: str, width: int, height: int, info: dict[str, Any], stat: os.stat_result) -> tuple:
+    metadata = info.get("seed-alchemy")
+    return (
+        path,
+        collection_of(path),
+        width,
+        height,
+        getattr(stat, "st_birthtime", stat.st_mtime),  # st_ctime is the inode change time on Linux
+        stat.st_mtime,
+        json.dumps(info, default=repr),
+        metadata if isinstance(metadata, str) else None,
+    )
+
+
+def read_entry(user: str, path: str) -> Optional[tuple]:
+    full_path = config.get_image_path(user, path)
+    try:
+        stat = os.stat(full_path)
+        header = image_info.read_info_uncached(full_path)
+    except (OSError, ValueError):
+        return None
+    return make_entry(path, header.width, header.height, header.info, stat)
+
+
+def add(user: str, path: str, width: int, height: int, info: dict[str, Any]):
+    path = utils.normalize_path(path)
+    stat = os.stat(config.get_image_path(user, path))
+    insert(user, make_entry(path, width, height, info, stat))
+
+
+def add_file(user: str, path: str):
+    entry = read_entry(user, utils.normalize_path(path))
+    if entry:
+        insert(user, entry)
+
+
+def insert(user: str, entry: tuple):
+    connection = connect(user)
+    with transaction(connection):
+        connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entry)
+        log_change(connection, entry[0], True)
+
+
+def move(user: str, src_path: str, dst_path: str):
+    move_many(user, [(src_path, dst_path)])
+
+
+def move_many(user: str, moves: list[tuple[str, str]]):
+    rows = []
+    for src_path, dst_path in moves:
+        dst_path = utils.normalize_path(dst_path)
+        # The file's own mtime, so a rescan sees the moved file as unchanged
+        modified = os.stat(config.get_image_path(user, dst_path)).st_mtime
+        rows.append((dst_path, collection_of(dst_path), modified, utils.normalize_path(src_path)))
+
+    connection = connect(user)
+    with transaction(connection):
+        for row in rows:
+            cursor = connection.execute("UPDATE images SET path = ?, collection = ?, modified = ? WHERE path = ?", row)
+            log_change(connection, row[3], False)
+            if cursor.rowcount == 0:
+                # The source was never catalogued, the destination is read from the moved file
+                entry = read_entry(user, row[0])
+                if entry is None:
+                    continue
+                connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entry)
+            log_change(connection, row[0], True)
+
+
+def remove(user: str, path: str):
+    remove_many(user, [path])
+
+
+def remove_many(user: str, paths: list[str]):
+    connection = connect(user)
+    with transaction(connection):
+        for path in paths:
+            path = utils.normalize_path(path)
+            connection.execute("DELETE FROM images WHERE path = ?", (path,))
+            log_change(connection, path, False)
+
+
+def is_image_file(file_name: str) -> bool:
+    # Skips the index counter, traces and hidden temporary files
+    return not file_name.startswith(".") and file_name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def scan_files(user: str, collection: str, recursive: bool) -> dict[str, float]:
+    images_path = config.get_images_path(user)
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(os.path.join(images_path, collection)):
+        for file_name in file_names:
+            if is_image_file(file_name):
+                full_path = os.path.join(dir_path, file_name)
+                try:
+                    files[utils.normalize_path(os.path.relpath(full_path, images_path))] = os.stat(full_path).st_mtime
+                except FileNotFoundError:
+                    pass
+        if not recursive:
+            break
+        dir_names[:] = [dir_name for dir_name in dir_names if not dir_name.startswith(".")]
+    return files
+
+
+def known_files(connection: sqlite3.Connection, collection: str, recursive: bool) -> dict[str, float]:
+    if not recursive:
+        rows = connection.execute("SELECT path, modified FROM images WHERE collection = ?", (collection,))
+    elif collection:
+        rows = connection.execute(
+            "SELECT path, modified FROM images WHERE collection = ? OR substr(collection, 1, ?) = ?",
+            (collection, len(collection) + 1, collection + "/"),
+        )
+    else:
+        rows = connection.execute("SELECT path, modified FROM images")
+    return dict(rows.fetchall())
+
+
+def sync(user: str, collection: str = "", recursive: bool = True) -> tuple[list[str], list[str]]:
+    # Brings the catalog in line with the files on disk, only files with a new mtime are read
+    connection = connect(user)
+    collection = utils.normalize_path(collection)
+    # Known rows first, a file that appears during the scan is then added rather than removed
+    known = known_files(connection, collection, recursive)
+    files = scan_files(user, collection, recursive)
+
+    entries = []
+    for path, modified in files.items():
+        if known.get(path) != modified:
+            entry = read_entry(user, path)
+            if entry:
+                entries.append(entry)
+    removed = [path for path in known.keys() if path not in files]
+    return apply(connection, entries, removed)
+
+
+def sync_paths(user: str, paths: list[str]) -> tuple[list[str], list[str]]:
+    # Same as sync for individual files, as reported by the watcher
+    connection = connect(user)
+    entries = []
+    removed = []
+    for path in paths:
+        path = utils.normalize_path(path)
+        row = connection.execute("SELECT modified FROM images WHERE path = ?", (path,)).fetchone()
+        try:
+            modified = os.stat(config.get_image_path(user, path)).st_mtime
+        except FileNotFoundError:
+            if row:
+                removed.append(path)
+            continue
+
+        if row is None or row[0] != modified:
+            entry = read_entry(user, path)
+            if entry:
+                entries.append(entry)
+    return apply(connection, entries, removed)
+
+
+def apply(connection: sqlite3.Connection, entries: list[tuple], removed: list[str]) -> tuple[list[str], list[str]]:
+    if entries or removed:
+        with transaction(connection):
+            for entry in entries:
+                connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entry)
+                log_change(connection, entry[0], True)
+            for path in removed:
+                connection.execute("DELETE FROM images WHERE path = ?", (path,))
+                log_change(connection, path, False)
+    return [entry[0] for entry in entries], removed
+
+
+def list_images(user: str, collection: str) -> list[str]:
+    rows = connect(user).execute(
+        "SELECT path FROM images WHERE collection = ? ORDER BY path DESC", (utils.normalize_path(collection),)
+    )
+    return [row[0] for row in rows]
+
+
+def list_paths(user: str) -> set[str]:
+    return {row[0] for row in connect(user).execute("SELECT path FROM images")}
+
+
+def get_info(user: str, path: str) -> Optional[dict[str, Any]]:
+    row = connect(user).execute("SELECT info FROM images WHERE path = ?", (utils.normalize_path(path),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def list_page(user: str, collection: str, limit: int, after: Optional[str]) -> tuple[list[str], bool]:
+    # Keyset pagination, newest first, after is the last path of the previous page
+    connection = connect(user)
+    collection = utils.normalize_path(collection)
+    if after is None:
+        rows = connection.execute(
+            "SELECT path FROM images WHERE collection = ? ORDER BY path DESC LIMIT ?", (collection, limit + 1)
+        )
+    else:
+        rows = connection.execute(
+            "SELECT path FROM images WHERE collection = ? AND path < ? ORDER BY path DESC LIMIT ?",
+            (collection, after, limit + 1),
+        )
+    paths = [row[0] for row in rows]
+    return paths[:limit], len(paths) > limit
+
+
+def change_token(user: str) -> int:
+    row = connect(user).execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row[0] if row else 0
+
+
+def changes_since(user: str, collection: str, token: int) -> Optional[tuple[list[str], list[str], int]]:
+    # Returns None when the token is older than the retained changes
+    connection = connect(user)
+    with transaction(connection, "DEFERRED"):
+        latest = change_token(user)
+        oldest = connection.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        if token > latest or (oldest is not None and token < oldest - 1) or (oldest is None and token < latest):
+            return None
+
+        rows = connection.execute(
+            "SELECT path, added FROM changes WHERE collection = ? AND seq > ? ORDER BY seq",
+            (utils.normalize_path(collection), token),
+        ).fetchall()
+
+    state = {}
+    for path, added in rows:
+        state[path] = bool(added)
+    added = sorted((path for path, present in state.items() if present), reverse=True)
+    removed = sorted(path for path, present in state.items() if not present)
+    return added, removed, latest
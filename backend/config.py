@@ -1,6 +1,9 @@
 import os
 import re
+import sys
+import threading
 import uuid
+from contextlib import contextmanager
 from typing import Optional
 
 from pydantic import BaseSettings, Field
@@ -26,6 +29,27 @@ class Settings(BaseSettings):
     install_control_net_v10: bool = False
     install_control_net_v11: bool = True
     install_control_net_mediapipe_v2: bool = True
+    max_batch_size: int = 4
+    worker_count: int = 0
+    job_retention: float = 3600.0
+    max_queue_depth: int = 64
+    max_user_queue_depth: int = 16
+    queue_timeout: Optional[float] = None
+    min_priority: int = -10
+    max_priority: int = 10  # Request priorities are clamped to this range
+    trace_requests: bool = False
+    thumbnail_workers: int = 2
+    image_writer_workers: int = 2
+    image_writer_queue_size: int = 8
+    output_format: str = "png"
+    output_preset: str = "balanced"
+    session_grace_period: float = 60.0  # Seconds a disconnected session keeps running, 0 cancels at once
+    preview_max_fps: float = 10.0  # 0 for a preview on every step
+    preview_step_interval: int = 1
+    preview_quality: int = 50  # WebP quality of preview frames
+    watch_images: bool = True
+    watch_poll_interval: Optional[float] = None  # Polls instead of using file system notifications when set
+    thumbnail_sizes: list[int] = Field(default_factory=lambda: [96, 256, 512], split=",")
 
     def __str__(self):
         return "\n".join(f"{key}={value}" for key, value in self.dict().items())
@@ -34,6 +58,8 @@ class Settings(BaseSettings):
 settings: Settings
 models: dict[str, ModelInfo] = {}  # Different namespace for each base model?
 promptgen_models: dict[str, str] = {}
+output_index_lock = threading.Lock()
+scanned_output_dirs: set[str] = set()
 
 
 def is_valid_diffusers_model(path: str):
@@ -150,8 +176,20 @@ def get_image_path(user: str, path: str):
     return os.path.join(settings.storage_path, user, "images", path)
 
 
-def get_thumbnail_path(user: str, path: str):
-    return os.path.join(settings.storage_path, user, "thumbnails", path)
+def get_catalog_path(user: str):
+    return os.path.join(settings.storage_path, user, "catalog.db")
+
+
+def get_trace_path(user: str, path: str):
+    return os.path.join(settings.storage_path, user, "images", f"{path}.trace.json")
+
+
+def get_thumbnails_path(user: str):
+    return os.path.join(settings.storage_path, user, "thumbnails")
+
+
+def get_thumbnail_path(user: str, path: str, size: int):
+    return os.path.join(get_thumbnails_path(user), str(size), f"{path}.webp")
 
 
 def get_cache_path(subfolder: str, path: Optional[str]):
@@ -162,21 +200,70 @@ def get_cache_path(subfolder: str, path: Optional[str]):
         return os.path.join(cache_dir, subfolder)
 
 
-def generate_output_path(user: str, dir: str) -> int:
-    full_path = get_image_path(user, dir)
-    if not os.path.exists(full_path):
-        os.makedirs(full_path, exist_ok=True)
+@contextmanager
+def locked_file(path: str):
+    # Exclusive lock shared with other processes, e.g. the worker pool
+    with open(path, "a+") as f:
+        if sys.platform == "win32":
+            import msvcrt
+
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            f.flush()
+            if sys.platform == "win32":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
 
+def scan_output_index(full_path: str) -> int:
     index = 0
     for image_file in os.listdir(full_path):
-        match = re.match(r"(\d+)\.[0-9a-f]+\.png", image_file)
-        if match:
-            index = max(index, int(match.group(1)))
-        match = re.match(r"(\d+)\.png", image_file)
+        match = re.match(r"(\d+)(\.[0-9a-f]+)?\.(png|webp|jpg|jpeg|gif|bmp)$", image_file, re.IGNORECASE)
         if match:
             index = max(index, int(match.group(1)))
+    return index
+
+
+def next_output_index(full_path: str, count: int = 1) -> int:
+    # The last used index is kept in a .index file, the directory is only scanned once per process
+    # Reserves count consecutive indices and returns the first
+    with output_index_lock, locked_file(os.path.join(full_path, ".index")) as f:
+        f.seek(0)
+        content = f.read().strip()
+        index = int(content) if content.isdigit() else 0
+        if full_path not in scanned_output_dirs:
+            index = max(index, scan_output_index(full_path))
+            scanned_output_dirs.add(full_path)
+
+        f.seek(0)
+        f.truncate()
+        f.write(str(index + count))
+    return index + 1
+
+
+def generate_output_paths(user: str, dir: str, exts: list[str]) -> list[str]:
+    # One index reservation for the whole list
+    full_path = get_image_path(user, dir)
+    if not os.path.exists(full_path):
+        os.makedirs(full_path, exist_ok=True)
+
+    index = next_output_index(full_path, len(exts)) if exts else 0
+
+    output_paths = []
+    for offset, ext in enumerate(exts):
+        short_uuid = str(uuid.uuid4())[:8]
+        output_paths.append(os.path.join(dir, "{:05d}.{:s}.{:s}".format(index + offset, short_uuid, ext)))
+    return output_paths
 
-    index += 1
 
-    short_uuid = str(uuid.uuid4())[:8]
-    return os.path.join(dir, "{:05d}.{:s}.png".format(index, short_uuid))
+def generate_output_path(user: str, dir: str, ext: str = "png") -> str:
+    return generate_output_paths(user, dir, [ext])[0]
@@ -13,5 +13,7 @@ def default_device():
 def default_dtype():
     if sys.platform == "darwin":
         return torch.float32        # TODO - user setting
+    elif default_device().type == "cpu":
+        return torch.float32        # Half precision is not supported by most CPU kernels
     else:
-        return torch.float16
\ No newline at end of file
+        return torch.float16
@@ -1,17 +1,22 @@
+import functools
 import io
 import json
 import os
-from typing import Optional
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Callable, Optional, Union
 
 import torch
-from PIL import Image, ImageOps, PngImagePlugin
+from PIL import Image, ImageOps
 
-from . import config, messages, utils
+from . import catalog, config, image_writer, messages, metrics, output_formats, thumbnails, tracing, utils
 from .control_net import ControlNetProcessor
 from .device import default_device, default_dtype
 from .esrgan import ESRGANProcessor
 from .gfpgan import GFPGANProcessor
-from .models import ImageRequest, PreviewType, ProcessRequest
+from .models import ImageRequest, OutputFormat, OutputPreset, PreviewType, ProcessRequest
+from .preview_worker import PreviewWorker
 from .session import CancelException, Session
 from .tiny_vae import TinyVAE
 from .universal_pipeline import UniversalPipeline
@@ -21,6 +26,65 @@ def align_down(n: int, align: int) -> int:
     return align * (n // align)
 
 
+class ImageTask:
+    def __init__(self, req: ImageRequest, session: Optional[Session]):
+        self.req = req
+        self.session = session
+        self.step = 0
+        self.cancelled = False
+        self.last_preview_time = float("-inf")
+        self.generator = torch.Generator().manual_seed(req.seed)
+        self.tracer = (
+            tracing.Tracer(f"generate {req.generator_id}") if req.trace or config.settings.trace_requests else None
+        )
+
+    def next_step(self):
+        req = self.req
+        self.step += 1
+
+        if self.session:
+            if self.session.cancel:
+                self.session.cancel = False
+                self.cancelled = True
+                raise CancelException()
+
+            steps = self.compute_steps()
+            progress_amount = int(self.step * 100 / steps)
+            self.session.queue.put_latest(
+                (messages.Type.PROGRESS, req.generator_id), messages.build_progress(req.generator_id, progress_amount)
+            )
+
+    def preview_due(self) -> bool:
+        # Frames over the limits are never built, rather than built and dropped
+        if self.step % max(1, config.settings.preview_step_interval):
+            return False
+        now = time.perf_counter()
+        if config.settings.preview_max_fps > 0 and now - self.last_preview_time < 1 / config.settings.preview_max_fps:
+            return False
+        self.last_preview_time = now
+        return True
+
+    def compute_steps(self):
+        req = self.req
+
+        steps_per_image = 1
+        if req.refiner and req.refiner.high_noise_end is None:
+            steps_per_image += int(req.refiner.steps * req.refiner.noise)
+        if req.high_res:
+            steps_per_image += int(req.high_res.steps * req.high_res.noise)
+        if req.upscale:
+            steps_per_image += 1
+        if req.face:
+            steps_per_image += 1
+
+        if req.img2img:
+            pipeline_steps = int(req.steps * req.img2img.noise)
+        else:
+            pipeline_steps = req.steps
+
+        return pipeline_steps + req.image_count * steps_per_image
+
+
 class ImageGenerator:
     def __init__(self, controlnet_processor: ControlNetProcessor):
         self.device = default_device()
@@ -32,23 +96,36 @@ class ImageGenerator:
         self.gfpgan = GFPGANProcessor()
         self.controlnet_processor = controlnet_processor
         self.tiny_vae = TinyVAE()
+        self.preview_worker = PreviewWorker(self.send_preview)
 
         # Generation state
-        self.req = None
-        self.session = None
-        self.step = -1
+        self.tasks: list[ImageTask] = []
+
+        # Optional handoff of post-processing to another executor, returns a future of the output paths
+        self.post_process_lane: Optional[Callable[..., Future]] = None
 
     def __call__(self, req: ImageRequest, session: Optional[Session]):
+        return self.batch([(req, session)])[0]
+
+    def batch(self, items: list[tuple[ImageRequest, Optional[Session]]]):
+        # Requests must share image_batch_key(), only prompts, seeds and post-processing may differ
+        tasks = [ImageTask(req, session) for req, session in items]
+        try:
+            with tracing.bind([task.tracer for task in tasks]):
+                return self.generate(tasks)
+        finally:
+            self.preview_worker.discard(tasks)
+
+    def generate(self, tasks: list[ImageTask]) -> list[Union[list[str], Future]]:
         # Init
-        self.req = req
-        self.session = session
-        self.step = 0
+        req = tasks[0].req
+        self.tasks = tasks
 
         # Source image
         source_image = None
         if req.img2img:
             full_path = config.get_image_path(req.user, req.img2img.source)
-            with Image.open(full_path) as image:
+            with metrics.stage("image_load"), Image.open(full_path) as image:
                 image = image.convert("RGB")
                 source_image = image.copy()
 
@@ -56,7 +133,7 @@ class ImageGenerator:
         mask_image = None
         if req.inpaint:
             full_path = config.get_image_path(req.user, req.inpaint.source)
-            with Image.open(full_path) as image:
+            with metrics.stage("image_load"), Image.open(full_path) as image:
                 if req.inpaint.use_alpha_channel:
                     image = image.split()[3].convert("L")
                 else:
@@ -72,27 +149,27 @@ class ImageGenerator:
         if req.control_net:
             for condition in req.control_net.conditions:
                 full_path = config.get_image_path(req.user, condition.source)
-                with Image.open(full_path) as image:
-                    if condition.processor != "none":
+                with metrics.stage("image_load"), Image.open(full_path) as image:
+                    image.load()
+                if condition.processor != "none":
+                    with metrics.stage("controlnet_detect"):
                         image = self.controlnet_processor(
                             image, min(req.width, req.height), condition.processor, condition.params
                         )
-                        image = image.resize((req.width, req.height), Image.Resampling.LANCZOS)
-                    control_images.append(image.copy())
+                    image = image.resize((req.width, req.height), Image.Resampling.LANCZOS)
+                control_images.append(image.copy())
 
         # Pipelines
-        self.base_pipeline.load(req.model, req.safety_checker, req.control_net, None)
-        self.base_pipeline.set_scheduler(req.scheduler)
-        self.base_pipeline.set_loras(req.lora.entries if req.lora else [])
-
-        if req.refiner:
-            self.refiner_pipeline.load(req.refiner.model, req.safety_checker, None, self.base_pipeline.pipe)
-            self.refiner_pipeline.set_scheduler(req.scheduler)
-        else:
-            self.refiner_pipeline.unload()
-
-        # Seed
-        generator = torch.Generator().manual_seed(req.seed)
+        with metrics.stage("pipeline_setup"):
+            self.base_pipeline.load(req.model, req.safety_checker, req.control_net, None)
+            self.base_pipeline.set_scheduler(req.scheduler)
+            self.base_pipeline.set_loras(req.lora.entries if req.lora else [])
+
+            if req.refiner:
+                self.refiner_pipeline.load(req.refiner.model, req.safety_checker, None, self.base_pipeline.pipe)
+                self.refiner_pipeline.set_scheduler(req.scheduler)
+            else:
+                self.refiner_pipeline.unload()
 
         try:
             # Generate
@@ -102,10 +179,22 @@ class ImageGenerator:
                 if source_image is not None:
                     source_image = source_image.resize((req.width, req.height), Image.Resampling.LANCZOS)
 
+                if len(tasks) == 1:
+                    image_count = req.image_count
+                    prompt = req.prompt
+                    negative_prompt = req.negative_prompt
+                    generator = tasks[0].generator
+                else:
+                    # Repeating a generator per image draws the same noise as an unbatched request
+                    image_count = [task.req.image_count for task in tasks]
+                    prompt = [task.req.prompt for task in tasks]
+                    negative_prompt = [task.req.negative_prompt for task in tasks]
+                    generator = [task.generator for task in tasks for _ in range(task.req.image_count)]
+
                 images = self.base_pipeline(
-                    image_count=req.image_count,
-                    prompt=req.prompt,
-                    negative_prompt=req.negative_prompt,
+                    image_count=image_count,
+                    prompt=prompt,
+                    negative_prompt=negative_prompt,
                     steps=req.steps,
                     denoising_start=None,
                     denoising_end=req.refiner.high_noise_end if req.refiner else None,
@@ -121,69 +210,139 @@ class ImageGenerator:
                     output_type="latent" if req.refiner else "pil",
                     callback=self.callback,
                 )
+        except CancelException:
+            return [[] for _ in tasks]
+
+        # Post-process
+        results = []
+        offset = 0
+        for task in tasks:
+            task_images = images[offset : offset + task.req.image_count]
+            offset += task.req.image_count
+
+            if task.cancelled:
+                results.append([])
+                continue
+
+            self.tasks = [task]
+            try:
+                with tracing.bind([task.tracer]):
+                    task_images = self.refine(task, task_images, mask_image, control_images)
+            except CancelException:
+                results.append([])
+                continue
+
+            # Upscaling and saving run on the post-processing lane when available, freeing this one
+            if self.post_process_lane:
+                results.append(self.post_process_lane(self.post_process, task, task_images))
+            else:
+                results.append(self.post_process(task, task_images))
+
+        return results
+
+    def refine(
+        self,
+        task: ImageTask,
+        images: list[Image.Image],
+        mask_image: Optional[Image.Image],
+        control_images: list[Image.Image],
+    ) -> list[Image.Image]:
+        req = task.req
+        generator = task.generator
+
+        refined_images = []
+        for image in images:
+            # Refiner
+            if req.refiner:
+                image = self.refiner_pipeline(
+                    image_count=1,
+                    prompt=req.prompt,
+                    negative_prompt=req.negative_prompt,
+                    steps=req.steps if req.refiner.high_noise_end is not None else req.refiner.steps,
+                    denoising_start=req.refiner.high_noise_end,
+                    denoising_end=None,
+                    cfg_scale=req.refiner.cfg_scale,
+                    width=req.width,
+                    height=req.height,
+                    generator=generator,
+                    noise=req.refiner.noise if req.refiner.high_noise_end is None else None,
+                    source_image=image,
+                    mask_image=mask_image,
+                    control_net=None,
+                    control_images=None,
+                    output_type="pil",
+                    callback=self.callback,
+                    stage="refiner",
+                )[0]
 
-            # Post-process
-            output_paths = []
-            for image in images:
-                # Refiner
-                if req.refiner:
-                    image = self.refiner_pipeline(
-                        image_count=1,
-                        prompt=req.prompt,
-                        negative_prompt=req.negative_prompt,
-                        steps=req.steps if req.refiner.high_noise_end is not None else req.refiner.steps,
-                        denoising_start=req.refiner.high_noise_end,
-                        denoising_end=None,
-                        cfg_scale=req.refiner.cfg_scale,
-                        width=req.width,
-                        height=req.height,
-                        generator=generator,
-                        noise=req.refiner.noise if req.refiner.high_noise_end is None else None,
-                        source_image=image,
-                        mask_image=mask_image,
-                        control_net=None,
-                        control_images=None,
-                        output_type="pil",
-                        callback=self.callback,
-                    )[0]
-
-                # High Resolution
-                if req.high_res:
-                    high_res_width = align_down(int(req.width * req.high_res.factor), 8)
-                    high_res_height = align_down(int(req.height * req.high_res.factor), 8)
-                    source_image = image.resize((high_res_width, high_res_height), Image.Resampling.LANCZOS)
-                    if mask_image is not None:
-                        mask_image = mask_image.resize((high_res_width, high_res_height), Image.Resampling.LANCZOS)
-
-                    orig_control_images = control_images
-                    control_images = []
-                    for control_image in orig_control_images:
-                        control_images.append(
-                            control_image.resize((high_res_width, high_res_height), Image.Resampling.LANCZOS)
-                        )
+            # High Resolution
+            if req.high_res:
+                high_res_width = align_down(int(req.width * req.high_res.factor), 8)
+                high_res_height = align_down(int(req.height * req.high_res.factor), 8)
+                source_image = image.resize((high_res_width, high_res_height), Image.Resampling.LANCZOS)
+                if mask_image is not None:
+                    mask_image = mask_image.resize((high_res_width, high_res_height), Image.Resampling.LANCZOS)
+
+                orig_control_images = control_images
+                control_images = []
+                for control_image in orig_control_images:
+                    control_images.append(
+                        control_image.resize((high_res_width, high_res_height), Image.Resampling.LANCZOS)
+                    )
+
+                image = self.base_pipeline(
+                    image_count=1,
+                    prompt=req.prompt,
+                    negative_prompt=req.negative_prompt,
+                    steps=req.high_res.steps,
+                    denoising_start=None,
+                    denoising_end=None,
+                    cfg_scale=req.high_res.cfg_scale,
+                    width=high_res_width,
+                    height=high_res_height,
+                    generator=generator,
+                    noise=req.high_res.noise,
+                    source_image=source_image,
+                    mask_image=mask_image,
+                    control_net=req.control_net,
+                    control_images=control_images,
+                    output_type="pil",
+                    callback=self.callback,
+                    stage="high_res",
+                )[0]
+
+            refined_images.append(image)
+        return refined_images
+
+    def post_process(self, task: ImageTask, images: list[Image.Image]) -> Union[list[str], Future]:
+        try:
+            with tracing.bind([task.tracer]):
+                output_paths, writes = self.upscale_and_save(task, images)
+        except CancelException:
+            return []
+
+        # Completes once the files are on disk, so the paths are never served before they exist
+        return image_writer.when_all(writes, lambda: self.finish(task, output_paths))
+
+    def finish(self, task: ImageTask, output_paths: list[str]) -> list[str]:
+        if task.tracer:
+            task.tracer.add("request", task.tracer.origin, time.perf_counter(), {"outputs": output_paths})
+            for output_path in output_paths:
+                task.tracer.save(config.get_trace_path(task.req.user, output_path))
+        return output_paths
+
+    def upscale_and_save(self, task: ImageTask, images: list[Image.Image]) -> tuple[list[str], list[Future]]:
+        req = task.req
+
+        output_format = req.output_format or OutputFormat(config.settings.output_format)
+        output_preset = req.output_preset or OutputPreset(config.settings.output_preset)
 
-                    image = self.base_pipeline(
-                        image_count=1,
-                        prompt=req.prompt,
-                        negative_prompt=req.negative_prompt,
-                        steps=req.high_res.steps,
-                        denoising_start=None,
-                        denoising_end=None,
-                        cfg_scale=req.high_res.cfg_scale,
-                        width=high_res_width,
-                        height=high_res_height,
-                        generator=generator,
-                        noise=req.high_res.noise,
-                        source_image=source_image,
-                        mask_image=mask_image,
-                        control_net=req.control_net,
-                        control_images=control_images,
-                        output_type="pil",
-                        callback=self.callback,
-                    )[0]
-
-                # ESRGAN
-                if req.upscale:
+        output_paths = []
+        writes = []
+        for image in images:
+            # ESRGAN
+            if req.upscale:
+                with metrics.stage("esrgan"):
                     upscaled_image = self.esrgan(
                         image=image,
                         upscale_factor=req.upscale.factor,
@@ -191,108 +350,150 @@ class ImageGenerator:
                         blend_strength=req.upscale.blend,
                         float32=True,  # TODO - 16bit
                     )
-                    self.next_step()
-                else:
-                    upscaled_image = image
+                task.next_step()
+            else:
+                upscaled_image = image
 
-                # GFPGAN
-                if req.face:
+            # GFPGAN
+            if req.face:
+                with metrics.stage("gfpgan"):
                     image = self.gfpgan(
                         image=image,
                         upscale_factor=req.upscale.factor if req.upscale else 1,
                         upscaled_image=upscaled_image,
                         blend_strength=req.face.blend,
                     )
-                    self.next_step()
-                else:
-                    image = upscaled_image
-
-                # Metadata
-                filtered_dict = utils.remove_none_fields(req.dict())
-                for key in ["session_id", "generator_id", "user", "collection", "image_count", "preview"]:
-                    if key in filtered_dict:
-                        filtered_dict.pop(key)
-                png_info = PngImagePlugin.PngInfo()
-                png_info.add_text("seed-alchemy", json.dumps(filtered_dict))
-
-                # Serialize
-                output_path = config.generate_output_path(req.user, req.collection)
-                full_path = config.get_image_path(req.user, output_path)
-                with open(full_path, "wb") as f:
-                    image.save(f, pnginfo=png_info)
-                    f.flush()
-                    os.fsync(f.fileno())
-
-                self.next_step()
-
-                output_paths.append(utils.normalize_path(output_path))
-            return output_paths
-
-        except CancelException:
-            return []
-
-    def callback(self, step: int, timestep: int, latents: torch.FloatTensor):
-        req = self.req
-        self.next_step()
-
-        if self.session:
-            if req.high_res:
-                preview_width = align_down(int(req.width * req.high_res.factor), 8)
-                preview_height = align_down(int(req.height * req.high_res.factor), 8)
+                task.next_step()
             else:
-                preview_width = req.width
-                preview_height = req.height
+                image = upscaled_image
+
+            # Metadata
+            metadata_start_time = time.perf_counter()
+            filtered_dict = utils.remove_none_fields(req.dict())
+            for key in [
+                "session_id",
+                "generator_id",
+                "user",
+                "collection",
+                "image_count",
+                "preview",
+                "priority",
+                "timeout",
+                "trace",
+                "output_format",
+                "output_preset",
+            ]:
+                if key in filtered_dict:
+                    filtered_dict.pop(key)
+            metadata_text = json.dumps(filtered_dict)
+            tracing.record("metadata", metadata_start_time, time.perf_counter())
+
+            # Serialize, the path is reserved now and the encoding and write overlap the next image
+            output_path = config.generate_output_path(
+                req.user, req.collection, output_formats.EXTENSIONS[output_format]
+            )
+            write = image_writer.get_writer().submit(
+                self.write_image, req, output_path, image, output_format, output_preset, metadata_text, task.tracer
+            )
+            # Thumbnails follow the write, one created before the file exists would be stale
+            write.add_done_callback(functools.partial(self.submit_thumbnail, req.user, output_path, image))
+            writes.append(write)
+
+            task.next_step()
+
+            output_paths.append(utils.normalize_path(output_path))
+        return output_paths, writes
+
+    def submit_thumbnail(self, user: str, output_path: str, image: Image.Image, write: Future):
+        if write.exception() is None:
+            thumbnails.submit(user, output_path, image)
+
+    def write_image(
+        self,
+        req: ImageRequest,
+        output_path: str,
+        image: Image.Image,
+        output_format: OutputFormat,
+        output_preset: OutputPreset,
+        metadata_text: str,
+        tracer: Optional[tracing.Tracer],
+    ):
+        with tracing.bind([tracer]):
+            # Written under a hidden temporary name and renamed, the watcher never reads a partial file
+            full_path = config.get_image_path(req.user, output_path)
+            dir_path, file_name = os.path.split(full_path)
+            temp_path = os.path.join(dir_path, f".{file_name}.{uuid.uuid4().hex[:8]}.tmp")
+            try:
+                with open(temp_path, "wb") as f:
+                    with metrics.stage("image_encode"):
+                        output_formats.save(f, image, output_format, output_preset, metadata_text)
+                        f.flush()
+                    with metrics.stage("fsync"):
+                        os.fsync(f.fileno())
+                os.replace(temp_path, full_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            with metrics.stage("catalog"):
+                catalog.add(
+                    req.user, output_path, image.width, image.height, {output_formats.METADATA_KEY: metadata_text}
+                )
 
-            if req.upscale:
-                preview_width *= req.upscale.factor
-                preview_height *= req.upscale.factor
+    def callback(self, step: int, timestep: int, latents: torch.FloatTensor):
+        offset = 0
+        for task in self.tasks:
+            task_latents = latents[offset : offset + 1]
+            offset += task.req.image_count
 
-            if req.preview == PreviewType.TINY_VAE:
-                self.tiny_vae.load(self.base_pipeline.base_model_type)
-                image = self.tiny_vae.decode(latents)
-                image = image.resize((preview_width, preview_height), Image.BILINEAR)
-            else:
-                self.tiny_vae.unload()
-                image = self.base_pipeline.preview(latents)
-                image = image.resize((preview_width, preview_height), Image.NEAREST)
+            if task.cancelled:
+                continue
+            try:
+                task.next_step()
+            except CancelException:
+                continue
 
-            buffered = io.BytesIO()
-            image.save(buffered, format="png")
+            if task.session and task.session.previews and task.preview_due():
+                # An asynchronous copy on the GPU, decoding and encoding happen on the preview worker
+                with metrics.stage("preview_snapshot"):
+                    self.preview_worker.submit(task, task_latents.detach().clone())
 
-            self.session.queue.sync_q.put(messages.build_image(req.generator_id, buffered.getvalue()))
+        if all(task.cancelled for task in self.tasks):
+            raise CancelException()
 
-    def next_step(self):
-        req = self.req
-        self.step += 1
+    def send_preview(self, task: ImageTask, latents: torch.FloatTensor):
+        with tracing.bind([task.tracer]), torch.no_grad(), metrics.stage("preview"):
+            self.encode_preview(task, latents)
 
-        if self.session:
-            if self.session.cancel:
-                self.session.cancel = False
-                raise CancelException()
+    def encode_preview(self, task: ImageTask, latents: torch.FloatTensor):
+        req = task.req
 
-            steps = self.compute_steps()
-            progress_amount = int(self.step * 100 / steps)
-            self.session.queue.sync_q.put(messages.build_progress(req.generator_id, progress_amount))
-
-    def compute_steps(self):
-        req = self.req
-
-        steps_per_image = 1
-        if req.refiner and req.refiner.high_noise_end is None:
-            steps_per_image += int(req.refiner.steps * req.refiner.noise)
         if req.high_res:
-            steps_per_image += int(req.high_res.steps * req.high_res.noise)
+            preview_width = align_down(int(req.width * req.high_res.factor), 8)
+            preview_height = align_down(int(req.height * req.high_res.factor), 8)
+        else:
+            preview_width = req.width
+            preview_height = req.height
+
         if req.upscale:
-            steps_per_image += 1
-        if req.face:
-            steps_per_image += 1
+            preview_width *= req.upscale.factor
+            preview_height *= req.upscale.factor
 
-        if req.img2img:
-            pipeline_steps = int(req.steps * req.img2img.noise)
+        # Latent or tiny VAE resolution, not resized to the display size
+        if req.preview == PreviewType.TINY_VAE:
+            self.tiny_vae.load(self.base_pipeline.base_model_type)
+            image = self.tiny_vae.decode(latents)
         else:
-            pipeline_steps = req.steps
+            self.tiny_vae.unload()
+            image = self.base_pipeline.preview(latents)
 
-        return pipeline_steps + req.image_count * steps_per_image
+        buffered = io.BytesIO()
+        image.save(buffered, format="webp", quality=config.settings.preview_quality)
+
+        task.session.queue.put_latest(
+            (messages.Type.PREVIEW, req.generator_id),
+            messages.build_preview(req.generator_id, preview_width, preview_height, buffered.getvalue()),
+        )
 
 
 class PreviewProcessor:
@@ -310,5 +511,7 @@ class PreviewProcessor:
                 image.save(f)
                 f.flush()
                 os.fsync(f.fileno())
+            catalog.add(req.user, output_path, image.width, image.height, {})
+            thumbnails.submit(req.user, output_path, image)
 
         return utils.normalize_path(output_path)
@@ -0,0 +1,128 @@
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, BinaryIO
+
+from PIL import Image
+
+from . import output_formats
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@dataclass
+class ImageInfo:
+    width: int
+    height: int
+    info: dict[str, Any]
+
+
+def read_png(f: BinaryIO) -> ImageInfo:
+    # Text chunks before the first IDAT, the same ones PIL puts in image.info on open
+    width = height = 0
+    info = {}
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IDAT" or chunk_type == b"IEND":
+            break
+
+        if chunk_type in [b"IHDR", b"tEXt", b"zTXt", b"iTXt"]:
+            data = f.read(length)
+            f.seek(4, os.SEEK_CUR)
+        else:
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+
+        if chunk_type == b"IHDR":
+            width, height = struct.unpack(">II", data[:8])
+        elif chunk_type == b"tEXt":
+            key, _, value = data.partition(b"\0")
+            info[key.decode("latin-1")] = value.decode("latin-1")
+        elif chunk_type == b"zTXt":
+            key, _, value = data.partition(b"\0")
+            info[key.decode("latin-1")] = zlib.decompress(value[1:]).decode("latin-1")
+        elif chunk_type == b"iTXt":
+            key, _, rest = data.partition(b"\0")
+            compressed, rest = rest[0], rest[2:]
+            _, _, rest = rest.partition(b"\0")  # Language
+            _, _, value = rest.partition(b"\0")  # Translated keyword
+            if compressed:
+                value = zlib.decompress(value)
+            info[key.decode("latin-1")] = value.decode("utf-8")
+    return ImageInfo(width, height, info)
+
+
+def read_webp(f: BinaryIO) -> ImageInfo:
+    width = height = 0
+    info = {}
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk_type, length = struct.unpack("<4sI", header)
+        padded_length = length + (length & 1)
+
+        if chunk_type == b"VP8X":
+            data = f.read(10)
+            width = 1 + int.from_bytes(data[4:7], "little")
+            height = 1 + int.from_bytes(data[7:10], "little")
+            f.seek(padded_length - 10, os.SEEK_CUR)
+        elif chunk_type == b"VP8 " and not width:
+            data = f.read(10)
+            width = struct.unpack("<H", data[6:8])[0] & 0x3FFF
+            height = struct.unpack("<H", data[8:10])[0] & 0x3FFF
+            f.seek(padded_length - 10, os.SEEK_CUR)
+        elif chunk_type == b"VP8L" and not width:
+            data = f.read(5)
+            bits = int.from_bytes(data[1:5], "little")
+            width = 1 + (bits & 0x3FFF)
+            height = 1 + ((bits >> 14) & 0x3FFF)
+            f.seek(padded_length - 5, os.SEEK_CUR)
+        elif chunk_type == b"XMP ":
+            info["xmp"] = f.read(length).decode("utf-8", errors="replace")
+            f.seek(padded_length - length, os.SEEK_CUR)
+        else:
+            # Pixel data is skipped, not read
+            f.seek(padded_length, os.SEEK_CUR)
+    return ImageInfo(width, height, info)
+
+
+def read_header(full_path: str) -> ImageInfo:
+    with open(full_path, "rb") as f:
+        signature = f.read(12)
+        try:
+            if signature[:8] == PNG_SIGNATURE:
+                f.seek(8)
+                return read_png(f)
+            if signature[:4] == b"RIFF" and signature[8:12] == b"WEBP":
+                return read_webp(f)
+        except (struct.error, zlib.error, IndexError) as e:
+            raise ValueError(f"Malformed image header: {full_path}") from e
+
+    # Other formats, opening through PIL only parses the header
+    try:
+        with Image.open(full_path) as image:
+            return ImageInfo(image.width, image.height, image.info)
+    except Image.UnidentifiedImageError as e:
+        raise ValueError(f"Unknown image format: {full_path}") from e
+
+
+def read_info_uncached(full_path: str) -> ImageInfo:
+    # Raises OSError for unreadable files, ValueError for malformed ones
+    header = read_header(full_path)
+    return ImageInfo(header.width, header.height, output_formats.normalize_info(header.info))
+
+
+@lru_cache(maxsize=1024)
+def read_info_cached(full_path: str, mtime_ns: int) -> ImageInfo:
+    return read_info_uncached(full_path)
+
+
+def read_info(full_path: str) -> ImageInfo:
+    # A rewritten file gets a new mtime and so a new cache entry
+    return read_info_cached(full_path, os.stat(full_path).st_mtime_ns)
@@ -0,0 +1,75 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from . import config, metrics
+
+
+class ImageWriter:
+    # Encodes and writes finished images off the generation thread, bounded so memory stays flat
+    def __init__(self, workers: int, max_pending: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        # Blocks the caller while max_pending writes are in flight
+        with metrics.stage("write_wait"):
+            self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+writer: Optional[ImageWriter] = None
+lock = threading.Lock()
+
+
+def get_writer() -> ImageWriter:
+    global writer
+    with lock:
+        if writer is None:
+            writer = ImageWriter(config.settings.image_writer_workers, config.settings.image_writer_queue_size)
+        return writer
+
+
+def when_all(futures: list[Future], fn: Callable[[], Any]) -> Future:
+    # Future of fn(), called once every future has finished, or of the first failure
+    result = Future()
+    remaining = [len(futures)]
+    remaining_lock = threading.Lock()
+
+    def complete(_):
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+
+        for future in futures:
+            if future.exception():
+                result.set_exception(future.exception())
+                return
+        try:
+            result.set_result(fn())
+        except Exception as e:
+            result.set_exception(e)
+
+    if not futures:
+        complete(None)
+    for future in futures:
+        future.add_done_callback(complete)
+    return result
+
+
+def shutdown():
+    global writer
+    with lock:
+        image_writer, writer = writer, None
+    if image_writer is not None:
+        image_writer.shutdown()
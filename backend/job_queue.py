@@ -0,0 +1,322 @@
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import math
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Hashable, Optional
+from uuid import UUID, uuid4
+
+from . import messages, metrics
+from .session import Session
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Queue is full, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+@dataclass(order=True)
+class Job:
+    sort_key: tuple[int, int]
+    kind: str = field(compare=False)
+    fn: Callable[..., Any] = field(compare=False)
+    args: tuple = field(compare=False)
+    cost: float = field(compare=False)
+    session: Optional[Session] = field(compare=False)
+    generator_id: Optional[UUID] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    submit_time: float = field(compare=False)
+    batch_key: Optional[Hashable] = field(default=None, compare=False)
+    batch_fn: Optional[Callable[[list[tuple]], list[Any]]] = field(default=None, compare=False)
+    user: Optional[str] = field(default=None, compare=False)
+    deadline: Optional[float] = field(default=None, compare=False)
+    start_time: Optional[float] = field(default=None, compare=False)
+    end_time: Optional[float] = field(default=None, compare=False)
+    cancel_requested: bool = field(default=False, compare=False)
+    id: UUID = field(default_factory=uuid4, compare=False)
+
+    @property
+    def status(self) -> JobStatus:
+        if self.future.cancelled():
+            return JobStatus.CANCELLED
+        if self.future.done():
+            if self.future.exception():
+                return JobStatus.FAILED
+            return JobStatus.CANCELLED if self.cancel_requested else JobStatus.COMPLETED
+        return JobStatus.RUNNING if self.start_time is not None else JobStatus.QUEUED
+
+
+def chain_future(source: asyncio.Future, destination: asyncio.Future):
+    def copy(_):
+        if destination.done():
+            return
+        if source.cancelled():
+            destination.cancel()
+        elif source.exception():
+            destination.set_exception(source.exception())
+        else:
+            destination.set_result(source.result())
+
+    source.add_done_callback(copy)
+
+
+class JobQueue:
+    def __init__(
+        self,
+        executor: Executor,
+        concurrency: int = 1,
+        max_batch_size: int = 1,
+        max_depth: int = 0,
+        max_user_depth: int = 0,
+        retention: float = 3600.0,
+        smoothing: float = 0.2,
+    ):
+        self.executor = executor
+        self.concurrency = concurrency
+        self.max_batch_size = max_batch_size
+        self.max_depth = max_depth  # 0 for unlimited
+        self.max_user_depth = max_user_depth
+        self.retention = retention
+        self.smoothing = smoothing
+        self.jobs: dict[UUID, Job] = {}
+        self.heap: list[Job] = []
+        self.counter = itertools.count()
+        self.running: list[Job] = []
+        self.cost_times: dict[str, float] = {}  # Estimated seconds per unit of cost, per job kind
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.signals: Optional[asyncio.Queue] = None
+        self.worker_tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.signals = asyncio.Queue()
+        self.worker_tasks = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+
+    def submit(
+        self,
+        kind: str,
+        fn: Callable[..., Any],
+        *args: Any,
+        priority: int = 0,
+        cost: float = 1.0,
+        session: Optional[Session] = None,
+        generator_id: Optional[UUID] = None,
+        batch_key: Optional[Hashable] = None,
+        batch_fn: Optional[Callable[[list[tuple]], list[Any]]] = None,
+        user: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Job:
+        self.admit(user)
+
+        # Higher priority runs first, FIFO within a priority
+        job = Job(
+            sort_key=(-priority, next(self.counter)),
+            kind=kind,
+            fn=fn,
+            args=args,
+            cost=cost,
+            session=session,
+            generator_id=generator_id,
+            future=asyncio.get_running_loop().create_future(),
+            submit_time=time.perf_counter(),
+            batch_key=batch_key,
+            batch_fn=batch_fn,
+            user=user,
+        )
+        if timeout is not None:
+            job.deadline = job.submit_time + timeout
+            self.loop.call_later(timeout, self.expire, job)
+
+        heapq.heappush(self.heap, job)
+        if session:
+            session.tasks.append(job.future)
+
+        self.prune()
+        self.jobs[job.id] = job
+        job.future.add_done_callback(lambda _: setattr(job, "end_time", time.perf_counter()))
+
+        self.notify_positions()
+        self.signals.put_nowait(None)
+        return job
+
+    def admit(self, user: Optional[str]):
+        pending = self.running + self.heap
+        if self.max_depth and len(pending) >= self.max_depth:
+            raise QueueFullError(self.retry_after(pending))
+
+        if self.max_user_depth and user is not None:
+            user_pending = [job for job in pending if job.user == user]
+            if len(user_pending) >= self.max_user_depth:
+                raise QueueFullError(self.retry_after(user_pending))
+
+    def retry_after(self, jobs: list[Job]) -> int:
+        # Time until the first of these jobs completes and frees its place
+        completions = self.completion_estimates()
+        return max(1, math.ceil(min(completions.get(job.id, 0.0) for job in jobs)))
+
+    def expire(self, job: Job):
+        # Dropped before using any compute
+        if job.status == JobStatus.QUEUED:
+            self.heap.remove(job)
+            heapq.heapify(self.heap)
+            job.future.set_exception(DeadlineExceededError("Job waited in the queue past its deadline"))
+            self.notify_positions()
+
+    def get(self, job_id: UUID) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job: Job) -> bool:
+        job.cancel_requested = True
+        if job.status == JobStatus.QUEUED:
+            self.heap.remove(job)
+            heapq.heapify(self.heap)
+            job.future.cancel()
+            self.notify_positions()
+            return True
+
+        # Running jobs stop at their next step through the session cancel flag
+        if job.status == JobStatus.RUNNING and job.session:
+            job.session.cancel = True
+            return True
+        return False
+
+    def position(self, job: Job) -> int:
+        if job.status != JobStatus.QUEUED:
+            return 0
+        return sorted(self.heap).index(job) + 1
+
+    def prune(self):
+        now = time.perf_counter()
+        expired = [job_id for job_id, job in self.jobs.items() if job.end_time and now - job.end_time > self.retention]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def run(self, kind: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        job = self.submit(kind, fn, *args, **kwargs)
+        return await job.future
+
+    def submit_threadsafe(
+        self, kind: str, fn: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(self.run(kind, fn, *args, **kwargs), self.loop)
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # One signal per submitted job, jobs already taken by a batch leave the heap empty
+            await self.signals.get()
+            if not self.heap:
+                continue
+
+            batch = self.pop_batch()
+            start_time = time.perf_counter()
+            for job in batch:
+                job.start_time = start_time
+                metrics.stage_seconds.observe("queue_wait", value=start_time - job.submit_time)
+                if job.session:
+                    job.session.queue.put_latest(
+                        (messages.Type.QUEUE_STATUS, job.generator_id),
+                        messages.build_queue_status(job.generator_id, 0, 0),
+                    )
+            self.running.extend(batch)
+            self.notify_positions()
+
+            try:
+                if len(batch) == 1:
+                    results = [await loop.run_in_executor(self.executor, job.fn, *job.args)]
+                else:
+                    results = await loop.run_in_executor(self.executor, job.batch_fn, [job.args for job in batch])
+                for job, result in zip(batch, results):
+                    if isinstance(result, concurrent.futures.Future):
+                        # Handed off to another lane, the job completes when that work does
+                        chain_future(asyncio.wrap_future(result), job.future)
+                    elif not job.future.done():
+                        job.future.set_result(result)
+            except Exception as e:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            finally:
+                self.update_estimate(batch, time.perf_counter() - start_time)
+                self.running = [job for job in self.running if job not in batch]
+
+    def pop_batch(self) -> list[Job]:
+        job = heapq.heappop(self.heap)
+        if job.batch_key is None or job.batch_fn is None or self.max_batch_size <= 1:
+            return [job]
+
+        # Compatible jobs join in priority order, regardless of their position in the queue
+        batch = [job]
+        for other in sorted(self.heap):
+            if len(batch) >= self.max_batch_size:
+                break
+            if other.kind == job.kind and other.batch_key == job.batch_key:
+                batch.append(other)
+
+        if len(batch) > 1:
+            self.heap = [other for other in self.heap if other not in batch]
+            heapq.heapify(self.heap)
+        return batch
+
+    def update_estimate(self, batch: list[Job], elapsed: float):
+        kind = batch[0].kind
+        sample = elapsed / max(sum(job.cost for job in batch), 1e-6)
+        previous = self.cost_times.get(kind)
+        if previous is None:
+            self.cost_times[kind] = sample
+        else:
+            self.cost_times[kind] = previous + self.smoothing * (sample - previous)
+
+    def estimate(self, job: Job) -> float:
+        return self.cost_times.get(job.kind, 0.0) * job.cost
+
+    def depth(self) -> int:
+        return len(self.heap) + len(self.running)
+
+    def remaining(self) -> float:
+        now = time.perf_counter()
+        return sum(max(0.0, self.estimate(job) - (now - job.start_time)) for job in self.running)
+
+    def completion_estimates(self) -> dict[UUID, float]:
+        # Work ahead of a job is shared between the concurrent workers
+        now = time.perf_counter()
+        estimates = {job.id: max(0.0, self.estimate(job) - (now - job.start_time)) for job in self.running}
+        work = sum(estimates.values())
+        for job in sorted(self.heap):
+            estimates[job.id] = work / self.concurrency + self.estimate(job)
+            work += self.estimate(job)
+        return estimates
+
+    def notify_positions(self):
+        work = self.remaining()
+        for position, job in enumerate(sorted(self.heap)):
+            if job.session:
+                wait = work / self.concurrency
+                job.session.queue.put_latest(
+                    (messages.Type.QUEUE_STATUS, job.generator_id),
+                    messages.build_queue_status(job.generator_id, position + 1, int(wait * 1000)),
+                )
+            work += self.estimate(job)
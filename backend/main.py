@@ -1,42 +1,48 @@
 import argparse
 import asyncio
+import base64
+import json
 import os
 import shutil
 import sys
 from concurrent.futures import ThreadPoolExecutor
-from functools import lru_cache
-from typing import Any, Optional
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache, partial
+from typing import Any, BinaryIO, Optional
 from uuid import UUID, uuid4
 
-import janus
 from fastapi import (
     Depends,
     FastAPI,
     File,
     Form,
     HTTPException,
+    Query,
     Request,
     UploadFile,
     WebSocket,
     WebSocketDisconnect,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
-from PIL import Image
 from pydantic.json import ENCODERS_BY_TYPE
 from websockets.exceptions import ConnectionClosedError
 
-from . import config, messages, utils
+from . import catalog, config, image_info, image_writer, messages, metrics, thumbnails, utils, watcher
+from .job_queue import DeadlineExceededError, Job, JobQueue, JobStatus, QueueFullError
 from .models import (
     CancelRequest,
     ImageRequest,
     MoveRequest,
+    MovesRequest,
     PathRequest,
+    PathsRequest,
     ProcessRequest,
     PromptGenRequest,
+    image_batch_key,
 )
-from .session import Session
+from .session import ForwardingQueue, MessageQueue, NullQueue, Session
 
 # Configuration
 parser = argparse.ArgumentParser(description="Seed Alchemy Server")
@@ -48,9 +54,37 @@ print(config.settings)
 ENCODERS_BY_TYPE[bytes] = lambda bytes_obj: repr(bytes_obj)
 
 # Globals
-lock: asyncio.Lock = None
-executor = ThreadPoolExecutor(max_workers=1)
 sessions: dict[UUID, Session] = {}
+detached: dict[UUID, asyncio.TimerHandle] = {}  # Sessions without a websocket, until they expire
+closing: set[asyncio.Task] = set()
+
+# Worker pool mode runs image generation in separate processes
+worker_pool = None
+if config.settings.worker_count > 0:
+    from .worker_pool import WorkerPool
+
+    worker_pool = WorkerPool(config.settings.worker_count, args.root, config.settings.max_batch_size)
+
+
+def create_lane(concurrency: int, max_batch_size: int = 1, admission: bool = True) -> JobQueue:
+    return JobQueue(
+        ThreadPoolExecutor(max_workers=concurrency),
+        concurrency=concurrency,
+        max_batch_size=max_batch_size,
+        max_depth=config.settings.max_queue_depth if admission else 0,
+        max_user_depth=config.settings.max_user_queue_depth if admission else 0,
+        retention=config.settings.job_retention,
+    )
+
+
+# Execution lanes, so short tasks never wait behind a long generation on another lane
+lanes = {
+    "diffusion": create_lane(max(1, config.settings.worker_count), config.settings.max_batch_size),
+    "controlnet": create_lane(1),
+    "promptgen": create_lane(1),
+    "postprocess": create_lane(1, admission=False),  # Fed by admitted diffusion jobs
+}
+metrics.queue_depth.collect = lambda: {(name,): lane.depth() for name, lane in lanes.items()}
 
 # Fast API server
 app = FastAPI()
@@ -59,14 +93,6 @@ app.add_middleware(
 )
 
 
-def background_task(session: Optional[Session], *args: Any):
-    loop = asyncio.get_event_loop()
-    task = loop.run_in_executor(executor, *args)
-    if session:
-        session.tasks.append(task)
-    return task
-
-
 @lru_cache(maxsize=1)
 def controlnet_processor():
     from .control_net import ControlNetProcessor
@@ -76,16 +102,23 @@ def controlnet_processor():
 
 @lru_cache(maxsize=1)
 def image_generator():
+    if worker_pool:
+        return worker_pool
+
     from .image_generator import ImageGenerator
 
-    return ImageGenerator(controlnet_processor())
+    generator = ImageGenerator(controlnet_processor())
+    generator.post_process_lane = partial(lanes["postprocess"].submit_threadsafe, "postprocess")
+    return generator
 
 
 @lru_cache(maxsize=1)
 def preview_processor():
+    from .control_net import ControlNetProcessor
     from .image_generator import PreviewProcessor
 
-    return PreviewProcessor(controlnet_processor())
+    # Separate detector instance as the ControlNet lane runs alongside diffusion
+    return PreviewProcessor(ControlNetProcessor())
 
 
 @lru_cache(maxsize=1)
@@ -97,8 +130,51 @@ def prompt_generator():
 
 @app.on_event("startup")
 async def startup_event():
-    global lock
-    lock = asyncio.Lock()
+    if worker_pool:
+        worker_pool.start()
+    for lane in lanes.values():
+        lane.start()
+
+    # Watching starts first so nothing changed during the rescan is missed, the catalog updates are idempotent
+    if config.settings.watch_images:
+        watcher.start(config.settings.users)
+
+    # Catch up with changes made while the server was not running, before the first gallery request
+    loop = asyncio.get_running_loop()
+    for user in config.settings.users:
+        await loop.run_in_executor(None, watcher.rescan, user)
+        await loop.run_in_executor(None, thumbnails.remove_old_layout, user)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for session_id in list(detached.keys()):
+        await close_session(session_id)
+    for lane in lanes.values():
+        await lane.stop()
+    watcher.stop()
+    image_writer.shutdown()
+    thumbnails.shutdown()
+    if worker_pool:
+        worker_pool.stop()
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(DeadlineExceededError)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceededError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
+def queue_timeout(timeout: Optional[float]) -> Optional[float]:
+    return timeout if timeout is not None else config.settings.queue_timeout
+
+
+def queue_priority(priority: int) -> int:
+    return max(config.settings.min_priority, min(priority, config.settings.max_priority))
 
 
 @app.post("/api/v1/cancel")
@@ -106,27 +182,140 @@ async def post_cancel(req: CancelRequest):
     session = sessions.get(req.session_id)
     if session:
         session.cancel = True
+        if worker_pool and worker_pool.cancel(session):
+            session.cancel = False
     return
 
 
 @app.post("/api/v1/sd-generate")
 async def post_sd_generate(req: ImageRequest, generator=Depends(image_generator)):
-    async with lock:
-        session = sessions.get(req.session_id) if req.session_id else None
-        return await background_task(session, generator, req, session)
+    session = sessions.get(req.session_id) if req.session_id else None
+    job = submit_image_job(req, generator, session)
+    if session:
+        connection_count = session.connection_count
+
+        def replay_result(_):
+            # The response may not reach a client that reconnected, so results also go through the session
+            if session.connection_count != connection_count or req.session_id in detached:
+                notify_job_complete(job)
+
+        job.future.add_done_callback(replay_result)
+    return await job.future
+
+
+@app.post("/api/v1/jobs/sd-generate")
+async def post_job_sd_generate(req: ImageRequest, generator=Depends(image_generator)):
+    # Submitted jobs outlive the websocket, messages follow the session id rather than the connection
+    # Every job gets a session, its cancel flag is how a running job is stopped
+    if req.session_id:
+        session = Session(ForwardingQueue(sessions, req.session_id), False, [])
+    else:
+        session = Session(NullQueue(), False, [], previews=False)
+    job = submit_image_job(req, generator, session)
+    job.future.add_done_callback(lambda _: notify_job_complete(job))
+    return {"job_id": job.id}
+
+
+@app.get("/api/v1/jobs/{job_id}")
+async def get_job(job_id: UUID):
+    job = find_job(job_id)
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "position": lanes[job.kind].position(job),
+        **job_outcome(job),
+    }
+
+
+@app.get("/api/v1/jobs/{job_id}/result")
+async def get_job_result(job_id: UUID):
+    job = find_job(job_id)
+    status = job.status
+    if status in [JobStatus.QUEUED, JobStatus.RUNNING]:
+        raise HTTPException(status_code=409, detail=status)
+    if status == JobStatus.FAILED:
+        raise HTTPException(status_code=500, detail=str(job.future.exception()))
+    if job.future.cancelled():
+        return []
+    return job.future.result()
+
+
+@app.post("/api/v1/jobs/{job_id}/cancel")
+async def post_job_cancel(job_id: UUID):
+    job = find_job(job_id)
+    cancelled = lanes[job.kind].cancel(job)
+    if cancelled and worker_pool and job.session and worker_pool.cancel(job.session):
+        job.session.cancel = False
+    return {"job_id": job.id, "status": job.status}
+
+
+def submit_image_job(req: ImageRequest, generator: Any, session: Optional[Session]) -> Job:
+    job = lanes["diffusion"].submit(
+        "diffusion",
+        generator,
+        req,
+        session,
+        priority=queue_priority(req.priority),
+        cost=req.image_count * req.steps,
+        session=session,
+        generator_id=req.generator_id,
+        batch_key=image_batch_key(req),
+        batch_fn=generator.batch,
+        user=req.user,
+        timeout=queue_timeout(req.timeout),
+    )
+    if session:
+        # Progress and previews of a finished generation are not replayed to a resuming client
+        job.future.add_done_callback(lambda _: session.queue.forget(lambda key: key[1] == req.generator_id))
+    return job
+
+
+def find_job(job_id: UUID) -> Job:
+    for lane in lanes.values():
+        job = lane.get(job_id)
+        if job:
+            return job
+    raise HTTPException(status_code=404)
+
+
+def job_outcome(job: Job) -> dict[str, Any]:
+    outcome = {"status": job.status, "result": None, "error": None}
+    if job.status == JobStatus.FAILED:
+        outcome["error"] = str(job.future.exception())
+    elif job.future.done() and not job.future.cancelled():
+        outcome["result"] = job.future.result()
+    return outcome
+
+
+def notify_job_complete(job: Job):
+    if job.session:
+        data = json.dumps(job_outcome(job)).encode()
+        job.session.queue.put(messages.build_job_complete(job.id, data))
 
 
 @app.post("/api/v1/controlnet-process")
 async def post_control_net_process(req: ProcessRequest, processor=Depends(preview_processor)):
-    async with lock:
-        return await background_task(None, processor, req)
+    return await lanes["controlnet"].run(
+        "controlnet",
+        processor,
+        req,
+        priority=queue_priority(req.priority),
+        user=req.user,
+        timeout=queue_timeout(req.timeout),
+    )
 
 
 @app.post("/api/v1/prompt-generate")
 async def post_prompt_generate(req: PromptGenRequest, generator=Depends(prompt_generator)):
-    async with lock:
-        print("prompt_generate", req)
-        return await background_task(None, generator, req)
+    print("prompt_generate", req)
+    return await lanes["promptgen"].run(
+        "promptgen",
+        generator,
+        req,
+        priority=queue_priority(req.priority),
+        cost=req.count,
+        timeout=queue_timeout(req.timeout),
+    )
 
 
 @app.post("/api/v1/image-interrogate")
@@ -134,33 +323,68 @@ async def post_image_interrogate():
     pass
 
 
-@app.post("/api/v1/image-delete")
-async def post_image_delete(req: PathRequest):
-    image_full_path = config.get_image_path(req.user, req.path)
-    if os.path.exists(image_full_path):
+def delete_images(user: str, paths: list[str]):
+    # Traces go to the trash along with their images
+    full_paths = [config.get_image_path(user, path) for path in paths]
+    full_paths += [config.get_trace_path(user, path) for path in paths]
+    existing_paths = [full_path for full_path in full_paths if os.path.exists(full_path)]
+    if existing_paths:
         import send2trash
 
-        send2trash.send2trash(image_full_path)
+        # A single call, on macOS one Finder operation for the whole list
+        send2trash.send2trash(existing_paths)
+    catalog.remove_many(user, paths)
+    for path in paths:
+        thumbnails.remove(user, path)
+
 
-    thumbnail_full_path = config.get_thumbnail_path(req.user, req.path)
+def move_trace(user: str, src_path: str, dst_path: str):
     try:
-        os.remove(thumbnail_full_path)
+        os.replace(config.get_trace_path(user, src_path), config.get_trace_path(user, dst_path))
     except FileNotFoundError:
         pass
-    return
+
+
+def move_images(user: str, src_paths: list[str], dst_collection: str) -> list[Optional[str]]:
+    # Destination indices are reserved in one pass, None for sources that no longer exist
+    src_paths = [utils.normalize_path(path) for path in src_paths]
+    # Sorted so the moved images keep their relative order
+    sources = sorted(path for path in set(src_paths) if os.path.exists(config.get_image_path(user, path)))
+    output_paths = config.generate_output_paths(user, dst_collection, [file_extension(path) for path in sources])
+
+    moved = {}
+    try:
+        for src_path, output_path in zip(sources, output_paths):
+            output_path = utils.normalize_path(output_path)
+            shutil.move(config.get_image_path(user, src_path), config.get_image_path(user, output_path))
+            thumbnails.move(user, src_path, output_path)
+            move_trace(user, src_path, output_path)
+            moved[src_path] = output_path
+    finally:
+        catalog.move_many(user, list(moved.items()))
+    return [moved.get(path) for path in src_paths]
+
+
+@app.post("/api/v1/image-delete")
+async def post_image_delete(req: PathRequest):
+    await asyncio.get_running_loop().run_in_executor(None, delete_images, req.user, [req.path])
+
+
+@app.post("/api/v1/images-delete")
+async def post_images_delete(req: PathsRequest):
+    await asyncio.get_running_loop().run_in_executor(None, delete_images, req.user, req.paths)
 
 
 @app.post("/api/v1/image-move")
 async def post_image_move(req: MoveRequest):
-    src_full_path = config.get_image_path(req.user, req.src_path)
-    if not os.path.exists(src_full_path):
-        return
+    loop = asyncio.get_running_loop()
+    return (await loop.run_in_executor(None, move_images, req.user, [req.src_path], req.dst_collection))[0]
 
-    output_path = config.generate_output_path(req.user, req.dst_collection)
-    dst_full_path = config.get_image_path(req.user, output_path)
 
-    shutil.move(src_full_path, dst_full_path)
-    return output_path
+@app.post("/api/v1/images-move")
+async def post_images_move(req: MovesRequest):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, move_images, req.user, req.src_paths, req.dst_collection)
 
 
 @app.post("/api/v1/reveal")
@@ -178,6 +402,11 @@ async def post_reveal(req: PathRequest) -> None:
             subprocess.run(["explorer", "/select,", full_path])
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/v1/users")
 async def get_users():
     return config.settings.users
@@ -245,69 +474,168 @@ async def get_collections(user: str):
 
 @app.get("/api/v1/images/{user}/{collection}")
 async def get_images(user: str, collection: str):
-    full_path = config.get_image_path(user, collection)
-    if not os.path.exists(full_path):
-        return []
+    # The first connection on a thread creates the schema, which waits on the catalog's write lock
+    return await asyncio.get_running_loop().run_in_executor(None, catalog.list_images, user, collection)
 
-    list = sorted(
-        [
-            os.path.join(collection, file)
-            for file in os.listdir(full_path)
-            if file.lower().endswith((".webp", ".png", ".jpg", ".jpeg", ".gif", ".bmp"))
-        ]
-    )
-    list.reverse()
-    return list
+
+@app.get("/api/v1/gallery/{user}/{collection}")
+async def get_gallery_page(
+    user: str, collection: str, limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None
+):
+    after = decode_cursor(cursor) if cursor else None
+    return await asyncio.get_running_loop().run_in_executor(None, gallery_page, user, collection, limit, after)
+
+
+def gallery_page(user: str, collection: str, limit: int, after: Optional[str]) -> dict[str, Any]:
+    # The token is read first, anything changing during the listing is reported again by the changes endpoint
+    token = catalog.change_token(user)
+    paths, more = catalog.list_page(user, collection, limit, after)
+    return {
+        "items": paths,
+        "next_cursor": encode_cursor(paths[-1]) if more else None,
+        "token": token,
+    }
+
+
+@app.get("/api/v1/gallery/{user}/{collection}/changes")
+async def get_gallery_changes(user: str, collection: str, since: int):
+    return await asyncio.get_running_loop().run_in_executor(None, gallery_changes, user, collection, since)
+
+
+def gallery_changes(user: str, collection: str, since: int) -> dict[str, Any]:
+    changes = catalog.changes_since(user, collection, since)
+    if changes is None:
+        # Too far behind, the client reloads from the first page
+        return {"reset": True, "added": [], "removed": [], "token": catalog.change_token(user)}
+
+    added, removed, token = changes
+    return {"reset": False, "added": added, "removed": removed, "token": token}
+
+
+def encode_cursor(path: str) -> str:
+    return base64.urlsafe_b64encode(path.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 @app.get("/api/v1/metadata/{user}/{path:path}")
 async def get_metadata(user: str, path: str):
-    full_path = config.get_image_path(user, path)
+    # Adding a file reads its header and waits on the catalog's write lock
+    return await asyncio.get_running_loop().run_in_executor(None, catalog_info, user, path)
+
+
+def catalog_info(user: str, path: str) -> dict[str, Any]:
+    info = catalog.get_info(user, path)
+    if info is None:
+        # Not catalogued yet, e.g. copied into the collection by hand
+        if not os.path.exists(config.get_image_path(user, path)):
+            return {}
+        catalog.add_file(user, path)
+        info = catalog.get_info(user, path) or {}
+    return info
+
+
+@app.post("/api/v1/metadata")
+async def post_metadata(req: PathsRequest):
+    # Header and text chunks only, no pixel decoding
+    return await asyncio.get_running_loop().run_in_executor(None, read_metadata, req.user, req.paths)
+
+
+def read_metadata(user: str, paths: list[str]) -> dict[str, dict[str, Any]]:
+    results = {}
+    for path in paths:
+        try:
+            results[path] = image_info.read_info(config.get_image_path(user, path)).info
+        except (OSError, ValueError):
+            results[path] = {}
+    return results
+
+
+@app.get("/api/v1/trace/{user}/{path:path}")
+async def get_trace(user: str, path: str):
+    full_path = config.get_trace_path(user, path)
     if not os.path.exists(full_path):
-        return {}
+        raise HTTPException(status_code=404)
 
-    with Image.open(full_path) as image:
-        return image.info
+    return FileResponse(full_path, media_type="application/json")
+
+
+def file_extension(file_name: Optional[str]) -> str:
+    # Files keep their encoding, so they keep their extension
+    ext = os.path.splitext(file_name or "")[1].lower()
+    return ext[1:] if ext in catalog.IMAGE_EXTENSIONS else "png"
 
 
 @app.post("/api/v1/upload")
 async def upload_image(image: UploadFile = File(...), user: str = Form(...), collection: str = Form(...)):
-    output_path = config.generate_output_path(user, collection)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, save_upload, image.file, user, collection, file_extension(image.filename)
+    )
+
+
+def save_upload(file: BinaryIO, user: str, collection: str, extension: str) -> str:
+    output_path = config.generate_output_path(user, collection, extension)
     full_path = config.get_image_path(user, output_path)
     with open(full_path, "wb") as dst:
-        shutil.copyfileobj(image.file, dst)
+        shutil.copyfileobj(file, dst)
+    catalog.add_file(user, output_path)
+    thumbnails.submit(user, output_path)
 
     return utils.normalize_path(output_path)
 
 
 @app.get("/images/{user}/{path:path}")
-async def get_image(user: str, path: str):
+async def get_image(user: str, path: str, request: Request):
     full_path = config.get_image_path(user, path)
     if not os.path.exists(full_path) or not os.path.isfile(full_path):
         raise HTTPException(status_code=404)
 
-    response = FileResponse(full_path)
-    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
-    return response
+    return file_response(request, full_path)
 
 
 @app.get("/thumbnails/{user}/{path:path}")
-async def get_thumbnail(user: str, path: str):
-    thumbnail_full_path = config.get_thumbnail_path(user, path)
+async def get_thumbnail(user: str, path: str, request: Request, size: Optional[int] = Query(None, gt=0)):
+    thumbnail_full_path = config.get_thumbnail_path(user, path, thumbnails.select_size(size))
     if not os.path.exists(thumbnail_full_path) or not os.path.isfile(thumbnail_full_path):
         image_full_path = config.get_image_path(user, path)
         if not os.path.exists(image_full_path) or not os.path.isfile(image_full_path):
             raise HTTPException(status_code=404)
 
-        with Image.open(image_full_path) as image:
-            thumbnail = utils.create_thumbnail(image, 256)
+        # Usually already queued when the image was saved, otherwise created now off the event loop
+        await asyncio.wrap_future(thumbnails.submit(user, path))
 
-            os.makedirs(os.path.dirname(thumbnail_full_path), exist_ok=True)
-            thumbnail.save(thumbnail_full_path, bitmap_format="webp")
+    return file_response(request, thumbnail_full_path)
 
-    response = FileResponse(thumbnail_full_path)
-    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
-    return response
+
+def file_response(request: Request, full_path: str) -> Response:
+    stat_result = os.stat(full_path)
+    etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                if int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp():
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+
+    return FileResponse(full_path, headers=headers, stat_result=stat_result)
 
 
 async def websocket_reader(websocket: WebSocket):
@@ -318,38 +646,79 @@ async def websocket_reader(websocket: WebSocket):
         print("Websocket disconnected")
 
 
+async def close_session(session_id: UUID):
+    detached.pop(session_id, None)
+    session = sessions.get(session_id)
+    if not session:
+        return
+
+    session.cancel = True
+    if worker_pool:
+        worker_pool.cancel(session)
+    await asyncio.gather(*session.tasks, return_exceptions=True)
+    sessions.pop(session_id, None)
+    session.queue.close()
+
+
+def detach_session(session_id: UUID):
+    # Work keeps running for the grace period, a client resuming in time picks up its messages
+    loop = asyncio.get_running_loop()
+
+    def expire():
+        # The loop only keeps weak references to tasks
+        task = asyncio.create_task(close_session(session_id))
+        closing.add(task)
+        task.add_done_callback(closing.discard)
+
+    detached[session_id] = loop.call_later(config.settings.session_grace_period, expire)
+
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, session_id: Optional[UUID] = None):
     await websocket.accept()
     reader_task = asyncio.create_task(websocket_reader(websocket))
 
-    session_id = uuid4()
-    queue = janus.Queue()
-    queue_task = None
-    session = Session(queue, False, [])
-    sessions[session_id] = session
+    # Only a detached session can be resumed, a connected one keeps its client
+    if session_id in detached:
+        detached.pop(session_id).cancel()
+        session = sessions[session_id]
+        session.connection_count += 1
+        session.queue.replay()
+    else:
+        session_id = uuid4()
+        session = Session(MessageQueue(), False, [])
+        sessions[session_id] = session
 
+    queue = session.queue
+    queue_task = None
     try:
         await websocket.send_bytes(messages.build_session_id(session_id))
 
         while not reader_task.done():
-            queue_task = asyncio.create_task(queue.async_q.get())
+            queue_task = asyncio.create_task(queue.get())
             done, _ = await asyncio.wait([queue_task, reader_task], return_when=asyncio.FIRST_COMPLETED)
             if queue_task in done:
                 message = await queue_task
-                await websocket.send_bytes(message)
+                queue_task = None
+                try:
+                    await websocket.send_bytes(message)
+                except BaseException:
+                    queue.restore()
+                    raise
 
     except (WebSocketDisconnect, ConnectionClosedError):
         print("Websocket disconnected")
-
-    session.cancel = True
-    for task in session.tasks:
-        await task
-    if queue_task:
-        queue_task.cancel()
-    queue.close()
-    await queue.wait_closed()
-    sessions.pop(session_id)
+    finally:
+        reader_task.cancel()
+        if queue_task:
+            # A message taken in the same wait the reader finished was not sent
+            if queue_task.done() and not queue_task.cancelled():
+                queue.restore()
+            queue_task.cancel()
+        if config.settings.session_grace_period > 0:
+            detach_session(session_id)
+        else:
+            await close_session(session_id)
 
 
 if os.path.exists("frontend/dist"):
@@ -8,6 +8,9 @@ class Type(enum.IntEnum):
     SESSION_ID = 1
     PROGRESS = 2
     IMAGE = 3
+    QUEUE_STATUS = 4
+    JOB_COMPLETE = 5
+    PREVIEW = 6
 
 
 def build_message(message_type: Type, data: bytes):
@@ -33,3 +36,24 @@ def build_image(generator_id: UUID, image_data: bytes):
         Type.IMAGE,
         struct.pack(f">16s{len(image_data)}s", uuid.bytes, image_data),
     )
+
+
+def build_preview(generator_id: UUID, display_width: int, display_height: int, image_data: bytes):
+    # The image stays at its native resolution, the client scales it to the display size
+    uuid = generator_id or UUID(int=0)
+    return build_message(
+        Type.PREVIEW,
+        struct.pack(f">16sii{len(image_data)}s", uuid.bytes, display_width, display_height, image_data),
+    )
+
+
+def build_queue_status(generator_id: Optional[UUID], position: int, wait_ms: int):
+    uuid = generator_id or UUID(int=0)
+    return build_message(Type.QUEUE_STATUS, struct.pack(">16sii", uuid.bytes, position, wait_ms))
+
+
+def build_job_complete(job_id: UUID, data: bytes):
+    return build_message(
+        Type.JOB_COMPLETE,
+        struct.pack(f">16s{len(data)}s", job_id.bytes, data),
+    )
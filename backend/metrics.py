@@ -0,0 +1,246 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from . import tracing
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def format_labels(names: tuple[str, ...], values: LabelValues, extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self.samples()]
+
+    def samples(self) -> list[str]:
+        return []
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def drain(self) -> dict[LabelValues, float]:
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, source: int, values: dict[LabelValues, float]):
+        for key, value in values.items():
+            self.inc(*key, amount=value)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), collect: Optional[Callable] = None):
+        super().__init__(name, help, labels)
+        self.values: dict[LabelValues, float] = {}
+        self.collect = collect  # Called at render time, returns {label_values: value}
+        self.remote: dict[int, dict[LabelValues, float]] = {}  # Last values reported by each worker process
+
+    def set(self, *label_values: str, value: float):
+        with self.lock:
+            self.values[label_values] = value
+
+    def drain(self) -> dict[LabelValues, float]:
+        # Gauges are not deltas, a worker process reports its current values
+        values = self.collect() if self.collect else None
+        with self.lock:
+            return dict(values) if values is not None else dict(self.values)
+
+    def merge(self, source: int, values: Optional[dict[LabelValues, float]]):
+        with self.lock:
+            if values is None:
+                self.remote.pop(source, None)
+            else:
+                self.remote[source] = values
+
+    def samples(self) -> list[str]:
+        values = self.collect() if self.collect else None
+        with self.lock:
+            if values is not None:
+                self.values = dict(values)
+            # Worker processes on the same device add up
+            totals = dict(self.values)
+            for remote_values in self.remote.values():
+                for key, value in remote_values.items():
+                    totals[key] = totals.get(key, 0) + value
+            return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in totals.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: dict[LabelValues, list[int]] = {}
+        self.sums: dict[LabelValues, float] = {}
+
+    def observe(self, *label_values: str, value: float):
+        with self.lock:
+            counts = self.counts.setdefault(label_values, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[label_values] = self.sums.get(label_values, 0.0) + value
+
+    def drain(self) -> dict[LabelValues, tuple[list[int], float]]:
+        with self.lock:
+            counts, sums = self.counts, self.sums
+            self.counts, self.sums = {}, {}
+        return {key: (counts[key], sums[key]) for key in counts}
+
+    def merge(self, source: int, values: dict[LabelValues, tuple[list[int], float]]):
+        with self.lock:
+            for key, (counts, total) in values.items():
+                merged = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+                for index, count in enumerate(counts):
+                    merged[index] += count
+                self.sums[key] = self.sums.get(key, 0.0) + total
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*label_values, value=time.perf_counter() - start_time)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {self.sums[key]}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def collect_rss():
+    try:
+        import psutil
+
+        return {(): psutil.Process().memory_info().rss}
+    except ImportError:
+        pass
+
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            return {(): int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")}
+    return {}
+
+
+def collect_torch_memory():
+    # Only report once torch is in use, /metrics should not pull it in
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return {}
+
+    values = {}
+    if torch.cuda.is_available():
+        values[("cuda", "allocated")] = torch.cuda.memory_allocated()
+        values[("cuda", "reserved")] = torch.cuda.memory_reserved()
+    elif torch.backends.mps.is_available():
+        values[("mps", "allocated")] = torch.mps.current_allocated_memory()
+    return values
+
+
+# Metrics
+stage_seconds = Histogram("seed_alchemy_stage_seconds", "Time spent in each generation stage", ("stage",))
+model_load_seconds = Histogram(
+    "seed_alchemy_model_load_seconds", "Time spent loading model components", ("component",)
+)
+pipeline_loads = Counter("seed_alchemy_pipeline_loads_total", "Diffusion pipelines loaded", ("model",))
+pipeline_unloads = Counter("seed_alchemy_pipeline_unloads_total", "Diffusion pipelines unloaded", ("model",))
+lora_applications = Counter("seed_alchemy_lora_applications_total", "LoRA weights applied to a pipeline", ("model",))
+queue_depth = Gauge("seed_alchemy_queue_depth", "Queued and running jobs per lane", ("lane",))
+process_rss = Gauge(
+    "seed_alchemy_process_resident_memory_bytes", "Resident memory of the server process", (), collect_rss
+)
+torch_memory = Gauge(
+    "seed_alchemy_torch_memory_bytes", "Torch device memory", ("device", "kind"), collect_torch_memory
+)
+
+
+# Recorded in worker processes when generation runs in a pool, merged into the server's metrics
+relayed = (stage_seconds, model_load_seconds, pipeline_loads, pipeline_unloads, lora_applications, torch_memory)
+
+
+def drain() -> dict[str, Any]:
+    return {metric.name: metric.drain() for metric in relayed}
+
+
+def merge(source: int, metrics: dict[str, Any]):
+    for metric in relayed:
+        if metric.name in metrics:
+            metric.merge(source, metrics[metric.name])
+
+
+def forget(source: int):
+    # A restarted worker process no longer holds the memory it reported
+    for metric in relayed:
+        if isinstance(metric, Gauge):
+            metric.merge(source, None)
+
+
+def observe_stage(name: str, start_time: float, end_time: float):
+    stage_seconds.observe(name, value=end_time - start_time)
+    tracing.record(name, start_time, end_time)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, start_time, time.perf_counter())
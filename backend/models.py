@@ -13,6 +13,18 @@ class PreviewType(str, Enum):
     TINY_VAE = "tiny_vae"
 
 
+class OutputFormat(str, Enum):
+    PNG = "png"
+    WEBP = "webp"
+    JPEG = "jpeg"
+
+
+class OutputPreset(str, Enum):
+    FAST = "fast"
+    BALANCED = "balanced"
+    SMALL = "small"
+
+
 class CancelRequest(BaseModel):
     session_id: UUID
 
@@ -83,6 +95,11 @@ class ImageRequest(BaseModel):
     collection: str = "outputs"
     image_count: int = 1
     preview: Optional[PreviewType] = PreviewType.LATENT
+    priority: int = 0
+    timeout: Optional[float] = None
+    trace: bool = False
+    output_format: Optional[OutputFormat] = None  # Server default when not set
+    output_preset: Optional[OutputPreset] = None
 
     model: str = "stable-diffusion-v1-5"
     scheduler: str = "euler_a"
@@ -104,6 +121,27 @@ class ImageRequest(BaseModel):
     inpaint: Optional[InpaintParams] = None
 
 
+def image_batch_key(req: ImageRequest) -> Optional[str]:
+    # Requests with equal keys can share a single batched denoise
+    if req.img2img or req.inpaint:
+        return None
+    return req.json(
+        include={
+            "user",
+            "model",
+            "scheduler",
+            "safety_checker",
+            "steps",
+            "cfg_scale",
+            "width",
+            "height",
+            "lora",
+            "control_net",
+            "refiner",
+        }
+    )
+
+
 class PromptGenRequest(BaseModel):
     model: str = "promptgen-lexart"
     prompt: str = ""
@@ -117,6 +155,8 @@ class PromptGenRequest(BaseModel):
     max_length: int = 150
     count: int = 5
     seed: int = 1
+    priority: int = 0
+    timeout: Optional[float] = None
 
 
 class ProcessRequest(BaseModel):
@@ -125,6 +165,8 @@ class ProcessRequest(BaseModel):
     source: str
     processor: str = "none"
     params: dict[str, float] = {}
+    priority: int = 0
+    timeout: Optional[float] = None
 
 
 class PathRequest(BaseModel):
@@ -132,7 +174,18 @@ class PathRequest(BaseModel):
     path: str
 
 
+class PathsRequest(BaseModel):
+    user: str
+    paths: list[str]
+
+
 class MoveRequest(BaseModel):
     user: str
     src_path: str
     dst_collection: str
+
+
+class MovesRequest(BaseModel):
+    user: str
+    src_paths: list[str]
+    dst_collection: str
@@ -0,0 +1,90 @@
+from typing import Any, BinaryIO, Optional
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from PIL import Image, PngImagePlugin
+
+from .models import OutputFormat, OutputPreset
+
+METADATA_KEY = "seed-alchemy"
+JPEG_COMMENT_PREFIX = b"seed-alchemy:"
+XMP_NAMESPACE = "https://github.com/seed-alchemy/ns/1.0/"
+
+EXTENSIONS = {
+    OutputFormat.PNG: "png",
+    OutputFormat.WEBP: "webp",
+    OutputFormat.JPEG: "jpg",
+}
+
+# Encoder arguments per preset, from fastest to smallest output
+SAVE_PARAMS = {
+    OutputFormat.PNG: {
+        OutputPreset.FAST: {"compress_level": 1},
+        OutputPreset.BALANCED: {"compress_level": 6},
+        OutputPreset.SMALL: {"compress_level": 9},
+    },
+    OutputFormat.WEBP: {
+        # For lossless WebP quality is the compression effort
+        OutputPreset.FAST: {"lossless": True, "quality": 0, "method": 0},
+        OutputPreset.BALANCED: {"lossless": True, "quality": 50, "method": 4},
+        OutputPreset.SMALL: {"lossless": True, "quality": 100, "method": 6},
+    },
+    OutputFormat.JPEG: {
+        OutputPreset.FAST: {"quality": 95, "subsampling": 0},
+        OutputPreset.BALANCED: {"quality": 95, "subsampling": 0, "optimize": True},
+        OutputPreset.SMALL: {"quality": 92, "subsampling": 0, "optimize": True, "progressive": True},
+    },
+}
+
+
+def build_xmp(metadata_text: str) -> bytes:
+    return (
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        f'<rdf:Description rdf:about="" xmlns:sa="{XMP_NAMESPACE}">'
+        f"<sa:metadata>{escape(metadata_text)}</sa:metadata>"
+        "</rdf:Description>"
+        "</rdf:RDF>"
+        "</x:xmpmeta>"
+    ).encode()
+
+
+def parse_xmp(xmp: Any) -> Optional[str]:
+    try:
+        root = ElementTree.fromstring(xmp)
+    except ElementTree.ParseError:
+        return None
+    element = root.find(f".//{{{XMP_NAMESPACE}}}metadata")
+    return element.text if element is not None else None
+
+
+def save(f: BinaryIO, image: Image.Image, format: OutputFormat, preset: OutputPreset, metadata_text: str):
+    params = SAVE_PARAMS[format][preset]
+    if format == OutputFormat.PNG:
+        png_info = PngImagePlugin.PngInfo()
+        png_info.add_text(METADATA_KEY, metadata_text)
+        image.save(f, format="PNG", pnginfo=png_info, **params)
+    elif format == OutputFormat.WEBP:
+        image.save(f, format="WEBP", xmp=build_xmp(metadata_text), **params)
+    elif format == OutputFormat.JPEG:
+        if image.mode not in ["RGB", "L"]:
+            image = image.convert("RGB")
+        image.save(f, format="JPEG", comment=JPEG_COMMENT_PREFIX + metadata_text.encode(), **params)
+    else:
+        raise ValueError(f"Unsupported output format: {format}")
+
+
+def normalize_info(info: dict[str, Any]) -> dict[str, Any]:
+    # WebP and JPEG carry the metadata in XMP or a comment, expose it under the same key as PNG
+    if METADATA_KEY in info:
+        return info
+
+    metadata_text = None
+    if "xmp" in info:
+        metadata_text = parse_xmp(info["xmp"])
+    elif isinstance(info.get("comment"), bytes) and info["comment"].startswith(JPEG_COMMENT_PREFIX):
+        metadata_text = info["comment"][len(JPEG_COMMENT_PREFIX) :].decode("utf-8", errors="replace")
+
+    if metadata_text is None:
+        return info
+    return {**info, METADATA_KEY: metadata_text}
@@ -0,0 +1,47 @@
+import threading
+from typing import Any, Callable, Optional
+
+
+class PreviewWorker:
+    # Decodes and encodes previews off the denoise loop, which only leaves a snapshot of its latents here
+    # One slot per task, a newer snapshot replaces one not yet encoded
+    def __init__(self, encode: Callable[[Any, Any], None]):
+        self.encode = encode
+        self.condition = threading.Condition()
+        self.pending: dict[Any, Any] = {}
+        self.current: Optional[Any] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def submit(self, task: Any, latents: Any):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="preview", daemon=True)
+                self.thread.start()
+            self.pending[task] = latents
+            self.condition.notify_all()
+
+    def discard(self, tasks: list[Any]):
+        # Drops unencoded snapshots and waits for one in progress, no preview follows the results
+        with self.condition:
+            for task in tasks:
+                self.pending.pop(task, None)
+            while any(self.current is task for task in tasks):
+                self.condition.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                task = next(iter(self.pending))
+                latents = self.pending.pop(task)
+                self.current = task
+
+            try:
+                self.encode(task, latents)
+            except Exception as e:
+                print("Failed to encode preview:", e)
+            finally:
+                with self.condition:
+                    self.current = None
+                    self.condition.notify_all()
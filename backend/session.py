@@ -1,15 +1,134 @@
+import asyncio
+import threading
 from asyncio import Future
+from collections import deque
 from dataclasses import dataclass
+from typing import Callable, Hashable, Optional
+from uuid import UUID
 
-import janus
+
+class MessageQueue:
+    # Producers on any thread never block, a slow client only delays the consumer
+    # A message put with a key replaces the unsent one with the same key, so it receives the latest state
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.lock = threading.Lock()
+        self.messages: deque[list] = deque()  # [key, message]
+        self.latest: dict[Hashable, list] = {}
+        self.sent: dict[Hashable, bytes] = {}  # Last message sent for each key, replayed when a client resumes
+        self.in_flight: Optional[list] = None
+        self.closed = False
+
+    def put(self, message: bytes):
+        self.append([None, message])
+
+    def put_latest(self, key: Hashable, message: bytes):
+        self.append([key, message])
+
+    def append(self, entry: list):
+        with self.lock:
+            if self.closed:
+                return
+            if entry[0] is not None:
+                queued = self.latest.get(entry[0])
+                if queued is not None:
+                    queued[1] = entry[1]
+                    return
+                self.latest[entry[0]] = entry
+            self.messages.append(entry)
+            if len(self.messages) == 1:
+                self.loop.call_soon_threadsafe(self.event.set)
+
+    async def get(self) -> bytes:
+        while True:
+            with self.lock:
+                if self.messages:
+                    self.in_flight = self.messages.popleft()
+                    key, message = self.in_flight
+                    if key is not None:
+                        del self.latest[key]
+                        self.sent[key] = message
+                    return message
+                self.event.clear()
+            await self.event.wait()
+
+    def restore(self):
+        # The last message from get() was not delivered, keyed ones come back through replay()
+        with self.lock:
+            if self.in_flight is not None and self.in_flight[0] is None:
+                self.messages.appendleft(self.in_flight)
+                if len(self.messages) == 1:
+                    self.loop.call_soon_threadsafe(self.event.set)
+            self.in_flight = None
+
+    def replay(self):
+        # Queues the last sent message for every key without a newer one pending
+        with self.lock:
+            for key, message in self.sent.items():
+                if key not in self.latest:
+                    entry = [key, message]
+                    self.latest[key] = entry
+                    self.messages.append(entry)
+            if self.messages:
+                self.loop.call_soon_threadsafe(self.event.set)
+
+    def forget(self, predicate: Callable[[Hashable], bool]):
+        # Keys of finished work are no longer replayed
+        with self.lock:
+            for key in [key for key in self.sent.keys() if predicate(key)]:
+                del self.sent[key]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.messages.clear()
+            self.latest.clear()
+            self.sent.clear()
 
 
 @dataclass
 class Session:
-    queue: janus.Queue
+    queue: MessageQueue
     cancel: bool
     tasks: list[Future]
+    connection_count: int = 1  # Incremented each time a client resumes the session
+    previews: bool = True  # False when no client receives the messages
 
 
 class CancelException(Exception):
     pass
+
+
+class NullQueue:
+    # For jobs without a websocket, the session then only carries the cancel flag
+    def put(self, message: bytes):
+        pass
+
+    def put_latest(self, key: Hashable, message: bytes):
+        pass
+
+    def forget(self, predicate: Callable[[Hashable], bool]):
+        pass
+
+
+class ForwardingQueue:
+    # Routes messages to whichever websocket session currently has the id, dropping them once it has expired
+    def __init__(self, sessions: dict[UUID, Session], session_id: UUID):
+        self.sessions = sessions
+        self.session_id = session_id
+
+    def put(self, message: bytes):
+        session = self.sessions.get(self.session_id)
+        if session:
+            session.queue.put(message)
+
+    def put_latest(self, key: Hashable, message: bytes):
+        session = self.sessions.get(self.session_id)
+        if session:
+            session.queue.put_latest(key, message)
+
+    def forget(self, predicate: Callable[[Hashable], bool]):
+        session = self.sessions.get(self.session_id)
+        if session:
+            session.queue.forget(predicate)
@@ -0,0 +1,145 @@
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from PIL import Image
+
+from . import config, utils
+
+DEFAULT_SIZE = 256
+WEBP_QUALITY = 85
+
+executor: Optional[ThreadPoolExecutor] = None
+pending: dict[str, Future] = {}
+lock = threading.RLock()  # Done callbacks run inline when a job finishes before submit() returns
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global executor
+    with lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=config.settings.thumbnail_workers, thread_name_prefix="thumbnail"
+            )
+        return executor
+
+
+def select_size(requested: Optional[int]) -> int:
+    # Smallest configured size that covers the request
+    sizes = sorted(config.settings.thumbnail_sizes)
+    requested = requested or DEFAULT_SIZE
+    for size in sizes:
+        if size >= requested:
+            return size
+    return sizes[-1]
+
+
+def submit(user: str, path: str, image: Optional[Image.Image] = None) -> Future:
+    # Joins a job already running for the same image, image skips reading the file back when still in memory
+    key = os.path.normpath(config.get_image_path(user, path))
+    thumbnail_executor = get_executor()
+    with lock:
+        future = pending.get(key)
+        if future is None:
+            future = thumbnail_executor.submit(create, user, path, image)
+            pending[key] = future
+            future.add_done_callback(lambda _: discard(key, future))
+        return future
+
+
+def discard(key: str, future: Future):
+    with lock:
+        if pending.get(key) is future:
+            del pending[key]
+
+
+def create(user: str, path: str, image: Optional[Image.Image]):
+    # Every size from a single decode, each one downscaled from the next larger thumbnail
+    if image is None:
+        with Image.open(config.get_image_path(user, path)) as image:
+            image.load()
+            create_sizes(user, path, image)
+    else:
+        create_sizes(user, path, image)
+
+
+def create_sizes(user: str, path: str, image: Image.Image):
+    # Thumbnails take the image's mtime, is_stale() then holds however the two writes were ordered
+    image_mtime_ns = os.stat(config.get_image_path(user, path)).st_mtime_ns
+    source = image
+    for size in sorted(config.settings.thumbnail_sizes, reverse=True):
+        thumbnail = utils.create_thumbnail(source, size)
+        thumbnail_full_path = config.get_thumbnail_path(user, path, size)
+        save(thumbnail, thumbnail_full_path)
+        os.utime(thumbnail_full_path, ns=(image_mtime_ns, image_mtime_ns))
+        source = thumbnail
+
+
+def save(thumbnail: Image.Image, thumbnail_full_path: str):
+    # Written under a temporary name and renamed, readers never see a partial file
+    dir_path, file_name = os.path.split(thumbnail_full_path)
+    os.makedirs(dir_path, exist_ok=True)
+    temp_path = os.path.join(dir_path, f".{file_name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        thumbnail.save(temp_path, format="WEBP", quality=WEBP_QUALITY)
+        os.replace(temp_path, thumbnail_full_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def is_stale(user: str, path: str) -> bool:
+    # The smallest size is written last, so it is only current when the whole set is
+    try:
+        thumbnail_mtime = os.stat(config.get_thumbnail_path(user, path, min(config.settings.thumbnail_sizes))).st_mtime
+        return thumbnail_mtime < os.stat(config.get_image_path(user, path)).st_mtime
+    except FileNotFoundError:
+        return True
+
+
+def move(user: str, src_path: str, dst_path: str):
+    # A missing size is left to be created on request
+    for size in config.settings.thumbnail_sizes:
+        dst_full_path = config.get_thumbnail_path(user, dst_path, size)
+        try:
+            os.makedirs(os.path.dirname(dst_full_path), exist_ok=True)
+            os.replace(config.get_thumbnail_path(user, src_path, size), dst_full_path)
+        except FileNotFoundError:
+            pass
+
+
+def remove(user: str, path: str):
+    for size in config.settings.thumbnail_sizes:
+        try:
+            os.remove(config.get_thumbnail_path(user, path, size))
+        except FileNotFoundError:
+            pass
+
+
+def remove_old_layout(user: str):
+    # Thumbnails used to mirror the images tree, every size now has its own numbered directory
+    thumbnails_path = config.get_thumbnails_path(user)
+    try:
+        entries = os.listdir(thumbnails_path)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.isdigit():
+            continue
+        full_path = os.path.join(thumbnails_path, entry)
+        if os.path.isdir(full_path):
+            shutil.rmtree(full_path, ignore_errors=True)
+        else:
+            os.remove(full_path)
+
+
+def shutdown():
+    global executor
+    with lock:
+        thumbnail_executor, executor = executor, None
+    if thumbnail_executor is not None:
+        thumbnail_executor.shutdown(wait=True)
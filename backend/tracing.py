@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+local = threading.local()
+
+
+class Tracer:
+    # Spans in the Chrome trace event format, viewable in chrome://tracing or Perfetto
+    def __init__(self, name: str):
+        self.name = name
+        self.origin = time.perf_counter()
+        self.events: list[dict[str, Any]] = []
+        self.threads: dict[int, str] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, start_time: float, end_time: float, args: Optional[dict[str, Any]] = None):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start_time - self.origin) * 1e6,
+            "dur": (end_time - start_time) * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = args
+
+        with self.lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def to_json(self) -> str:
+        with self.lock:
+            metadata = [
+                {"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": self.name}},
+                *[
+                    {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                    for tid, name in self.threads.items()
+                ],
+            ]
+            return json.dumps({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"})
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.to_json())
+
+
+def active() -> list[Tracer]:
+    return getattr(local, "tracers", [])
+
+
+@contextmanager
+def bind(tracers: list[Optional[Tracer]]) -> Iterator[None]:
+    # Spans recorded on this thread go to every bound tracer, a batch shares its stages
+    previous = active()
+    local.tracers = [tracer for tracer in tracers if tracer]
+    try:
+        yield
+    finally:
+        local.tracers = previous
+
+
+def record(name: str, start_time: float, end_time: float, **args: Any):
+    for tracer in active():
+        tracer.add(name, start_time, end_time, args)
+
+
+@contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start_time, time.perf_counter(), **args)
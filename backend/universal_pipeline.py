@@ -1,5 +1,7 @@
+import functools
 import gc
 import os
+import time
 from typing import Callable, Optional, Union
 
 import torch
@@ -23,12 +25,91 @@ from diffusers import (
 from diffusers.loaders import TextualInversionLoaderMixin
 from PIL import Image
 
-from . import config, lora, scheduler_registry
+from . import config, lora, metrics, scheduler_registry, tracing
 from .device import default_device, default_dtype
 from .models import ControlNetParams, LoraModelParams
 from .types import BaseModelType
 
 
+def batch_embeds(tensors: list[Optional[torch.Tensor]], counts: list[int]) -> Optional[torch.Tensor]:
+    # Compel truncates to the tokenizer length so embeddings from different prompts share a shape
+    if tensors[0] is None:
+        return None
+    return torch.cat([tensor.repeat_interleave(count, dim=0) for tensor, count in zip(tensors, counts)])
+
+
+# fast latents preview matrix for sdxl
+# generated by @StAlKeR7779
+SDXL_LATENT_RGB_FACTORS = [
+    #   R        G        B
+    [0.3816, 0.4930, 0.5320],
+    [-0.3753, 0.1631, 0.1739],
+    [0.1770, 0.3588, -0.2048],
+    [-0.4350, -0.2644, -0.4289],
+]
+
+# origingally adapted from code by @erucipe and @keturn here:
+# https://discuss.huggingface.co/t/decoding-latents-to-rgb-without-upscaling/23204/7
+
+# these updated numbers for v1.5 are from @torridgristle
+V1_5_LATENT_RGB_FACTORS = [
+    #    R        G        B
+    [0.3444, 0.1385, 0.0670],  # L1
+    [0.1247, 0.4027, 0.1494],  # L2
+    [-0.3192, 0.2513, 0.2103],  # L3
+    [-0.1307, -0.1874, -0.7445],  # L4
+]
+
+
+def create_latent_rgb_factors(
+    base_model_type: BaseModelType, device: torch.device, dtype: torch.dtype
+) -> torch.Tensor:
+    if base_model_type in [BaseModelType.SDXL, BaseModelType.SDXL_REFINER]:
+        return torch.tensor(SDXL_LATENT_RGB_FACTORS, dtype=dtype, device=device)
+    return torch.tensor(V1_5_LATENT_RGB_FACTORS, dtype=dtype, device=device)
+
+
+class StepTimer:
+    # Prompt encoding runs until start(), denoising until the last step callback, decoding to the output type follows
+    # Stages of the refiner and high resolution passes are prefixed, each one is recorded exactly once
+    def __init__(self, callback: Optional[Callable[[int, int, torch.FloatTensor], None]], prefix: str):
+        self.callback = callback
+        self.prefix = prefix
+        self.call_time = time.perf_counter()
+        self.start_time = self.call_time
+        self.last_step_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        metrics.observe_stage(self.prefix + "prompt_encoding", self.call_time, self.start_time)
+
+    def __call__(self, step: int, timestep: int, latents: torch.FloatTensor):
+        step_time = time.perf_counter()
+        tracing.record("step", self.last_step_time or self.start_time, step_time, step=step, timestep=int(timestep))
+        self.last_step_time = step_time
+        if self.callback:
+            self.callback(step, timestep, latents)
+
+    def finish(self, output_type: str):
+        end_time = time.perf_counter()
+        denoise_end_time = self.last_step_time or end_time
+        metrics.observe_stage(self.prefix + "denoise", self.start_time, denoise_end_time)
+        if output_type != "latent":
+            metrics.observe_stage(self.prefix + "vae_decode", denoise_end_time, end_time)
+
+
+def timed_steps(fn):
+    @functools.wraps(fn)
+    def wrapper(self, *args, callback=None, stage: Optional[str] = None, **kwargs):
+        timer = StepTimer(callback, f"{stage}_" if stage else "")
+        with tracing.span("pipeline_call", model=self.model):
+            result = fn(self, *args, callback=timer, **kwargs)
+            timer.finish(kwargs.get("output_type"))
+        return result
+
+    return wrapper
+
+
 class UniversalPipeline:
     def __init__(self):
         self.device = default_device()
@@ -41,21 +122,24 @@ class UniversalPipeline:
         self.scheduler_config = None
         self.compel = None
         self.compel2 = None
+        self.latent_rgb_factors = None
         self.control_nets: list[ControlNetModel] = []
         self.control_net_names: list[str] = []
+        self.task_pipelines: dict[tuple[str, tuple[str, ...]], DiffusionPipeline] = {}
 
+    @timed_steps
     def __call__(
         self,
-        image_count: int,
-        prompt: str,
-        negative_prompt: str,
+        image_count: Union[int, list[int]],
+        prompt: Union[str, list[str]],
+        negative_prompt: Union[str, list[str]],
         steps: int,
         denoising_start: Optional[float],
         denoising_end: Optional[float],
         cfg_scale: float,
         width: int,
         height: int,
-        generator: torch.Generator,
+        generator: Union[torch.Generator, list[torch.Generator]],
         noise: Optional[float],
         source_image: Optional[Union[Image.Image, torch.FloatTensor]],
         mask_image: Optional[Union[Image.Image, torch.FloatTensor]],
@@ -73,28 +157,25 @@ class UniversalPipeline:
         #     steps = scaled_steps
 
         # Prompt
-        if self.base_model_type == BaseModelType.SDXL:
-            # TODO - expose 2nd prompt
-            prompt2 = prompt
-            negative_prompt2 = negative_prompt
-
-            prompt1_embeds = self.compel(prompt)
-            prompt2_embeds, pooled_prompt_embeds = self.compel2(prompt2)
-            prompt_embeds = torch.cat((prompt1_embeds, prompt2_embeds), dim=-1)
-
-            negative_prompt1_embeds = self.compel(negative_prompt)
-            negative_prompt2_embeds, negative_pooled_prompt_embeds = self.compel2(negative_prompt2)
-            negative_prompt_embeds = torch.cat((negative_prompt1_embeds, negative_prompt2_embeds), dim=-1)
-
-        elif self.base_model_type == BaseModelType.SDXL_REFINER:
-            prompt_embeds, pooled_prompt_embeds = self.compel(prompt)
-            negative_prompt_embeds, negative_pooled_prompt_embeds = self.compel(negative_prompt)
-
+        if isinstance(prompt, list):
+            # Batched requests: one embedding row per image so each request keeps its own prompts
+            encoded = [self.encode_prompt(p, n) for p, n in zip(prompt, negative_prompt)]
+            (
+                prompt_embeds,
+                negative_prompt_embeds,
+                pooled_prompt_embeds,
+                negative_pooled_prompt_embeds,
+            ) = [batch_embeds(list(tensors), image_count) for tensors in zip(*encoded)]
+            num_images_per_prompt = 1
         else:
-            prompt_embeds = self.compel(prompt)
-            negative_prompt_embeds = self.compel(negative_prompt)
-            pooled_prompt_embeds = None
-            negative_pooled_prompt_embeds = None
+            (
+                prompt_embeds,
+                negative_prompt_embeds,
+                pooled_prompt_embeds,
+                negative_pooled_prompt_embeds,
+            ) = self.encode_prompt(prompt, negative_prompt)
+            num_images_per_prompt = image_count
+        callback.start()
 
         # Strength
         strength = noise or 0.0
@@ -112,10 +193,13 @@ class UniversalPipeline:
                 controlnet_conditioning_scale = controlnet_conditioning_scales
 
             if mask_image is not None:
-                return StableDiffusionControlNetInpaintPipeline(
-                    **self.pipe.components,
-                    controlnet=controlnet,
-                    requires_safety_checker=False,
+                return self.task_pipeline(
+                    "controlnet_inpaint",
+                    lambda: StableDiffusionControlNetInpaintPipeline(
+                        **self.pipe.components,
+                        controlnet=controlnet,
+                        requires_safety_checker=False,
+                    ),
                 )(
                     callback=callback,
                     control_image=control_image,
@@ -126,7 +210,7 @@ class UniversalPipeline:
                     image=source_image,
                     mask_image=mask_image,
                     negative_prompt_embeds=negative_prompt_embeds,
-                    num_images_per_prompt=image_count,
+                    num_images_per_prompt=num_images_per_prompt,
                     num_inference_steps=steps,
                     output_type=output_type,
                     prompt_embeds=prompt_embeds,
@@ -134,10 +218,13 @@ class UniversalPipeline:
                     width=width,
                 ).images
             elif source_image is not None:
-                return StableDiffusionControlNetImg2ImgPipeline(
-                    **self.pipe.components,
-                    controlnet=controlnet,
-                    requires_safety_checker=False,
+                return self.task_pipeline(
+                    "controlnet_img2img",
+                    lambda: StableDiffusionControlNetImg2ImgPipeline(
+                        **self.pipe.components,
+                        controlnet=controlnet,
+                        requires_safety_checker=False,
+                    ),
                 )(
                     callback=callback,
                     control_image=control_image,
@@ -146,7 +233,7 @@ class UniversalPipeline:
                     guidance_scale=cfg_scale,
                     image=source_image,
                     negative_prompt_embeds=negative_prompt_embeds,
-                    num_images_per_prompt=image_count,
+                    num_images_per_prompt=num_images_per_prompt,
                     num_inference_steps=steps,
                     output_type=output_type,
                     prompt_embeds=prompt_embeds,
@@ -154,9 +241,12 @@ class UniversalPipeline:
                 ).images
             else:
                 if self.base_model_type == BaseModelType.SDXL:
-                    return StableDiffusionXLControlNetPipeline(
-                        **self.pipe.components,
-                        controlnet=controlnet,
+                    return self.task_pipeline(
+                        "sdxl_controlnet",
+                        lambda: StableDiffusionXLControlNetPipeline(
+                            **self.pipe.components,
+                            controlnet=controlnet,
+                        ),
                     )(
                         callback=callback,
                         controlnet_conditioning_scale=controlnet_conditioning_scale,
@@ -167,7 +257,7 @@ class UniversalPipeline:
                         image=control_image,
                         negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
                         negative_prompt_embeds=negative_prompt_embeds,
-                        num_images_per_prompt=image_count,
+                        num_images_per_prompt=num_images_per_prompt,
                         num_inference_steps=steps,
                         output_type=output_type,
                         pooled_prompt_embeds=pooled_prompt_embeds,
@@ -175,10 +265,13 @@ class UniversalPipeline:
                         width=width,
                     ).images
                 else:
-                    return StableDiffusionControlNetPipeline(
-                        **self.pipe.components,
-                        controlnet=controlnet,
-                        requires_safety_checker=False,
+                    return self.task_pipeline(
+                        "controlnet",
+                        lambda: StableDiffusionControlNetPipeline(
+                            **self.pipe.components,
+                            controlnet=controlnet,
+                            requires_safety_checker=False,
+                        ),
                     )(
                         callback=callback,
                         controlnet_conditioning_scale=controlnet_conditioning_scale,
@@ -187,7 +280,7 @@ class UniversalPipeline:
                         height=height,
                         image=control_image,
                         negative_prompt_embeds=negative_prompt_embeds,
-                        num_images_per_prompt=image_count,
+                        num_images_per_prompt=num_images_per_prompt,
                         num_inference_steps=steps,
                         output_type=output_type,
                         prompt_embeds=prompt_embeds,
@@ -196,9 +289,12 @@ class UniversalPipeline:
 
         else:
             if mask_image is not None:
-                return StableDiffusionInpaintPipeline(
-                    **self.pipe.components,
-                    requires_safety_checker=False,
+                return self.task_pipeline(
+                    "inpaint",
+                    lambda: StableDiffusionInpaintPipeline(
+                        **self.pipe.components,
+                        requires_safety_checker=False,
+                    ),
                 )(
                     callback=callback,
                     generator=generator,
@@ -207,7 +303,7 @@ class UniversalPipeline:
                     image=source_image,
                     mask_image=mask_image,
                     negative_prompt_embeds=negative_prompt_embeds,
-                    num_images_per_prompt=image_count,
+                    num_images_per_prompt=num_images_per_prompt,
                     num_inference_steps=steps,
                     output_type=output_type,
                     prompt_embeds=prompt_embeds,
@@ -216,9 +312,12 @@ class UniversalPipeline:
                 ).images
             elif source_image is not None:
                 if self.base_model_type == BaseModelType.SDXL or self.base_model_type == BaseModelType.SDXL_REFINER:
-                    return StableDiffusionXLImg2ImgPipeline(
-                        **self.pipe.components,
-                        requires_aesthetics_score=self.base_model_type == BaseModelType.SDXL_REFINER,
+                    return self.task_pipeline(
+                        "sdxl_img2img",
+                        lambda: StableDiffusionXLImg2ImgPipeline(
+                            **self.pipe.components,
+                            requires_aesthetics_score=self.base_model_type == BaseModelType.SDXL_REFINER,
+                        ),
                     )(
                         callback=callback,
                         denoising_start=denoising_start,
@@ -228,7 +327,7 @@ class UniversalPipeline:
                         image=source_image,
                         negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
                         negative_prompt_embeds=negative_prompt_embeds,
-                        num_images_per_prompt=image_count,
+                        num_images_per_prompt=num_images_per_prompt,
                         num_inference_steps=steps,
                         output_type=output_type,
                         pooled_prompt_embeds=pooled_prompt_embeds,
@@ -236,16 +335,19 @@ class UniversalPipeline:
                         strength=strength,
                     ).images
                 else:
-                    return StableDiffusionImg2ImgPipeline(
-                        **self.pipe.components,
-                        requires_safety_checker=False,
+                    return self.task_pipeline(
+                        "img2img",
+                        lambda: StableDiffusionImg2ImgPipeline(
+                            **self.pipe.components,
+                            requires_safety_checker=False,
+                        ),
                     )(
                         callback=callback,
                         generator=generator,
                         guidance_scale=cfg_scale,
                         image=source_image,
                         negative_prompt_embeds=negative_prompt_embeds,
-                        num_images_per_prompt=image_count,
+                        num_images_per_prompt=num_images_per_prompt,
                         num_inference_steps=steps,
                         output_type=output_type,
                         prompt_embeds=prompt_embeds,
@@ -261,7 +363,7 @@ class UniversalPipeline:
                         height=height,
                         negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
                         negative_prompt_embeds=negative_prompt_embeds,
-                        num_images_per_prompt=image_count,
+                        num_images_per_prompt=num_images_per_prompt,
                         num_inference_steps=steps,
                         output_type=output_type,
                         pooled_prompt_embeds=pooled_prompt_embeds,
@@ -275,13 +377,53 @@ class UniversalPipeline:
                         guidance_scale=cfg_scale,
                         height=height,
                         negative_prompt_embeds=negative_prompt_embeds,
-                        num_images_per_prompt=image_count,
+                        num_images_per_prompt=num_images_per_prompt,
                         num_inference_steps=steps,
                         output_type=output_type,
                         prompt_embeds=prompt_embeds,
                         width=width,
                     ).images
 
+    def task_pipeline(self, mode: str, create: Callable[[], DiffusionPipeline]) -> DiffusionPipeline:
+        # Wrappers share the loaded components, created once per mode and ControlNet set instead of per call
+        key = (mode, tuple(self.control_net_names) if "controlnet" in mode else ())
+        pipeline = self.task_pipelines.get(key)
+        if pipeline is None:
+            pipeline = create()
+            self.task_pipelines[key] = pipeline
+
+        # Per request state set on the base pipeline after the wrapper was created
+        pipeline.scheduler = self.pipe.scheduler
+        if hasattr(self.pipe, "_lora_scale"):
+            pipeline._lora_scale = self.pipe._lora_scale
+        return pipeline
+
+    def encode_prompt(self, prompt: str, negative_prompt: str):
+        if self.base_model_type == BaseModelType.SDXL:
+            # TODO - expose 2nd prompt
+            prompt2 = prompt
+            negative_prompt2 = negative_prompt
+
+            prompt1_embeds = self.compel(prompt)
+            prompt2_embeds, pooled_prompt_embeds = self.compel2(prompt2)
+            prompt_embeds = torch.cat((prompt1_embeds, prompt2_embeds), dim=-1)
+
+            negative_prompt1_embeds = self.compel(negative_prompt)
+            negative_prompt2_embeds, negative_pooled_prompt_embeds = self.compel2(negative_prompt2)
+            negative_prompt_embeds = torch.cat((negative_prompt1_embeds, negative_prompt2_embeds), dim=-1)
+
+        elif self.base_model_type == BaseModelType.SDXL_REFINER:
+            prompt_embeds, pooled_prompt_embeds = self.compel(prompt)
+            negative_prompt_embeds, negative_pooled_prompt_embeds = self.compel(negative_prompt)
+
+        else:
+            prompt_embeds = self.compel(prompt)
+            negative_prompt_embeds = self.compel(negative_prompt)
+            pooled_prompt_embeds = None
+            negative_pooled_prompt_embeds = None
+
+        return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
+
     def load(
         self,
         model: str,
@@ -299,6 +441,7 @@ class UniversalPipeline:
                     control_net = self.control_nets[index]
                 except ValueError:
                     print("Loading ControlNet", condition.model)
+                    load_start_time = time.perf_counter()
                     model_info = config.models[condition.model]
                     variant = "fp16" if self.torch_dtype == torch.float16 else None
 
@@ -320,10 +463,13 @@ class UniversalPipeline:
                         )
                     control_net.to(self.device)
                     control_net.set_attention_slice("auto")
+                    metrics.model_load_seconds.observe("controlnet", value=time.perf_counter() - load_start_time)
 
                 new_control_nets.append(control_net)
                 new_control_net_names.append(condition.model)
 
+        if new_control_net_names != self.control_net_names:
+            self.task_pipelines = {key: pipeline for key, pipeline in self.task_pipelines.items() if not key[1]}
         self.control_nets = new_control_nets
         self.control_net_names = new_control_net_names
 
@@ -334,6 +480,7 @@ class UniversalPipeline:
 
         if not self.pipe:
             print("Loading Stable Diffusion Pipeline", model)
+            load_start_time = time.perf_counter()
             model_info = config.models[model]
             variant = "fp16" if self.torch_dtype == torch.float16 else None
 
@@ -398,8 +545,10 @@ class UniversalPipeline:
             if torch.cuda.is_available():
                 pipe.enable_model_cpu_offload()
             pipe.backup_weights = {}
+            metrics.model_load_seconds.observe("pipeline", value=time.perf_counter() - load_start_time)
 
             # Textual Inversions
+            load_start_time = time.perf_counter()
             if isinstance(pipe, TextualInversionLoaderMixin):
                 data = [
                     (key, info.path)
@@ -410,8 +559,10 @@ class UniversalPipeline:
                     tokens, paths = zip(*data)
                     print("Loading Textual Inversions")
                     pipe.load_textual_inversion(list(paths), list(tokens))
+            metrics.model_load_seconds.observe("textual_inversion", value=time.perf_counter() - load_start_time)
 
             # Compel
+            load_start_time = time.perf_counter()
             compel2 = None
             if model_info.base == BaseModelType.SD_1 or model_info.base == BaseModelType.SD_2:
                 compel = Compel(
@@ -442,6 +593,8 @@ class UniversalPipeline:
                 )
             else:
                 raise ValueError("Unsupported base model: ", model_info.base)
+            metrics.model_load_seconds.observe("compel", value=time.perf_counter() - load_start_time)
+            metrics.pipeline_loads.inc(model)
 
             self.model = model
             self.base_model_type = model_info.base
@@ -450,8 +603,12 @@ class UniversalPipeline:
             self.scheduler_config = pipe.scheduler.config.copy()
             self.compel = compel
             self.compel2 = compel2
+            # Built once per model, previews only multiply by it
+            self.latent_rgb_factors = create_latent_rgb_factors(model_info.base, self.device, self.torch_dtype)
 
     def unload(self):
+        if self.pipe:
+            metrics.pipeline_unloads.inc(self.model)
         self.model = None
         self.base_model_type = None
         self.safety_checker = None
@@ -459,6 +616,8 @@ class UniversalPipeline:
         self.scheduler_config = None
         self.compel = None
         self.compel2 = None
+        self.latent_rgb_factors = None
+        self.task_pipelines = {}
         gc.collect()
 
     def set_scheduler(self, scheduler: str):
@@ -474,8 +633,10 @@ class UniversalPipeline:
                     lora_weight = loras[0]
                     info = config.models.get(lora_weight.model)
                     if info:
-                        self.pipe.load_lora_weights(info.path)
+                        with metrics.model_load_seconds.time("lora"):
+                            self.pipe.load_lora_weights(info.path)
                         self.pipe._lora_scale = lora_weight.weight
+                        metrics.lora_applications.inc(lora_weight.model)
                     else:
                         print("Unknown LoRA: ", lora_weight.model)
                 else:
@@ -486,56 +647,23 @@ class UniversalPipeline:
             for lora_entry in loras:
                 info = config.models.get(lora_entry.model)
                 if info:
-                    lora_models.append(lora.load(info.path, self.device, self.torch_dtype))
+                    with metrics.model_load_seconds.time("lora"):
+                        lora_models.append(lora.load(info.path, self.device, self.torch_dtype))
                     lora_multipliers.append(lora_entry.weight)
+                    metrics.lora_applications.inc(lora_entry.model)
                 else:
                     print("Unknown LoRA: ", lora_entry.model)
 
-            lora.apply(self.pipe, lora_models, lora_multipliers)
+            with metrics.stage("lora_apply"):
+                lora.apply(self.pipe, lora_models, lora_multipliers)
 
     def preview(self, latents):
         # Code from InvokeAI
         # https://github.com/invoke-ai/InvokeAI/blob/89b82b3dc4892f2bbf6d15f4e39c56225a54f3a6/invokeai/app/util/step_callback.py#L12
+        latent_rgb_factors = self.latent_rgb_factors.to(dtype=latents.dtype, device=latents.device)
+        latent_image = latents[0].permute(1, 2, 0) @ latent_rgb_factors
+        latents_ubyte = (
+            ((latent_image + 1) / 2).clamp(0, 1).mul(0xFF).byte()  # change scale from -1..1 to 0..1  # to 0..255
+        ).cpu()
 
-        def to_image(samples, latent_rgb_factors):
-            latent_image = samples[0].permute(1, 2, 0) @ latent_rgb_factors
-            latents_ubyte = (
-                ((latent_image + 1) / 2).clamp(0, 1).mul(0xFF).byte()  # change scale from -1..1 to 0..1  # to 0..255
-            ).cpu()
-
-            return Image.fromarray(latents_ubyte.numpy())
-
-        if self.base_model_type in [BaseModelType.SDXL, BaseModelType.SDXL_REFINER]:
-            # fast latents preview matrix for sdxl
-            # generated by @StAlKeR7779
-            sdxl_latent_rgb_factors = torch.tensor(
-                [
-                    #   R        G        B
-                    [0.3816, 0.4930, 0.5320],
-                    [-0.3753, 0.1631, 0.1739],
-                    [0.1770, 0.3588, -0.2048],
-                    [-0.4350, -0.2644, -0.4289],
-                ],
-                dtype=latents.dtype,
-                device=latents.device,
-            )
-
-            return to_image(latents, sdxl_latent_rgb_factors)
-        else:
-            # origingally adapted from code by @erucipe and @keturn here:
-            # https://discuss.huggingface.co/t/decoding-latents-to-rgb-without-upscaling/23204/7
-
-            # these updated numbers for v1.5 are from @torridgristle
-            v1_5_latent_rgb_factors = torch.tensor(
-                [
-                    #    R        G        B
-                    [0.3444, 0.1385, 0.0670],  # L1
-                    [0.1247, 0.4027, 0.1494],  # L2
-                    [-0.3192, 0.2513, 0.2103],  # L3
-                    [-0.1307, -0.1874, -0.7445],  # L4
-                ],
-                dtype=latents.dtype,
-                device=latents.device,
-            )
-
-            return to_image(latents, v1_5_latent_rgb_factors)
+        return Image.fromarray(latents_ubyte.numpy())
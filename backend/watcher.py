@@ -0,0 +1,120 @@
+import os
+import threading
+from typing import Optional
+
+from . import catalog, config, thumbnails, utils
+
+DEFAULT_POLL_INTERVAL = 2.0
+DEBOUNCE_MS = 500  # Lets a file being written settle before its header is read
+
+thread: Optional[threading.Thread] = None
+stop_event = threading.Event()
+
+
+def update(user: str, added: list[str], removed: list[str]):
+    for path in added:
+        if thumbnails.is_stale(user, path):
+            thumbnails.submit(user, path)
+    for path in removed:
+        thumbnails.remove(user, path)
+
+
+def rescan(user: str):
+    # Incremental, only files whose mtime differs from the catalog are read
+    # Thumbnails are only refreshed for files changed since they were catalogued, new files get theirs on request
+    # Otherwise a first start with an empty catalog would decode the whole library alongside generation
+    catalogued = catalog.list_paths(user)
+    added, removed = catalog.sync(user)
+    update(user, [path for path in added if path in catalogued], removed)
+
+
+def handle_changes(user: str, changed_paths: set[str]):
+    images_path = config.get_images_path(user)
+    file_paths = []
+    for full_path in changed_paths:
+        path = utils.normalize_path(os.path.relpath(full_path, images_path))
+        # Hidden names include files still being written under a temporary name
+        if path.startswith("..") or os.path.basename(path).startswith("."):
+            continue
+        if catalog.is_image_file(os.path.basename(path)):
+            file_paths.append(path)
+        elif not os.path.isfile(full_path):
+            # Directories created, renamed or deleted as a whole are reported once, not per file
+            update(user, *catalog.sync(user, path))
+    if file_paths:
+        update(user, *catalog.sync_paths(user, file_paths))
+
+
+def run_notify(users: list[str]):
+    from watchfiles import watch
+
+    roots = {os.path.normpath(config.get_images_path(user)): user for user in users}
+    for changes in watch(*roots.keys(), watch_filter=None, debounce=DEBOUNCE_MS, stop_event=stop_event):
+        changed_paths: dict[str, set[str]] = {}
+        for _, full_path in changes:
+            for root, user in roots.items():
+                if full_path.startswith(root + os.sep):
+                    changed_paths.setdefault(user, set()).add(full_path)
+        for user, paths in changed_paths.items():
+            try:
+                handle_changes(user, paths)
+            except Exception as e:
+                print("Failed to update catalog:", e)
+
+
+def snapshot(user: str) -> dict[str, int]:
+    # Creating, renaming or deleting a file changes its directory's mtime
+    images_path = config.get_images_path(user)
+    dirs = {}
+    for dir_path, dir_names, _ in os.walk(images_path):
+        dir_names[:] = [dir_name for dir_name in dir_names if not dir_name.startswith(".")]
+        try:
+            dirs[utils.normalize_path(os.path.relpath(dir_path, images_path))] = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return dirs
+
+
+def run_polling(users: list[str], interval: float):
+    snapshots = {user: snapshot(user) for user in users}
+    while not stop_event.wait(interval):
+        for user in users:
+            previous, current = snapshots[user], snapshot(user)
+            snapshots[user] = current
+            for dir_path in previous.keys() | current.keys():
+                if previous.get(dir_path) != current.get(dir_path):
+                    collection = "" if dir_path == "." else dir_path
+                    try:
+                        update(user, *catalog.sync(user, collection, recursive=False))
+                    except Exception as e:
+                        print("Failed to update catalog:", e)
+
+
+def start(users: list[str]):
+    global thread
+    for user in users:
+        os.makedirs(config.get_images_path(user), exist_ok=True)
+
+    interval = config.settings.watch_poll_interval
+    if interval is None:
+        try:
+            import watchfiles  # noqa: F401
+
+            target, target_args = run_notify, (users,)
+        except ImportError:
+            print("watchfiles not installed, polling for image changes")
+            target, target_args = run_polling, (users, DEFAULT_POLL_INTERVAL)
+    else:
+        target, target_args = run_polling, (users, interval)
+
+    stop_event.clear()
+    thread = threading.Thread(target=target, args=target_args, name="image-watcher", daemon=True)
+    thread.start()
+
+
+def stop():
+    global thread
+    stop_event.set()
+    if thread is not None:
+        thread.join()
+        thread = None
@@ -0,0 +1,257 @@
+import itertools
+import multiprocessing as mp
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future, TimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Hashable, Optional
+
+from . import config, metrics
+from .models import ImageRequest
+from .session import Session
+
+
+def affinity(req: ImageRequest) -> dict[str, Any]:
+    return {
+        "model": (req.model, req.safety_checker),
+        "refiner": req.refiner.model if req.refiner else None,
+        "control_nets": sorted(condition.model for condition in req.control_net.conditions) if req.control_net else [],
+        "loras": sorted((entry.model, entry.weight) for entry in req.lora.entries) if req.lora else [],
+    }
+
+
+def affinity_score(loaded: Optional[dict[str, Any]], wanted: dict[str, Any]) -> int:
+    # Weighted by the cost of reloading each component
+    if loaded is None:
+        return 0
+
+    score = 0
+    if loaded["model"] == wanted["model"]:
+        score += 8
+    if loaded["control_nets"] == wanted["control_nets"]:
+        score += 4
+    if loaded["refiner"] == wanted["refiner"]:
+        score += 2
+    if loaded["loras"] == wanted["loras"]:
+        score += 1
+    return score
+
+
+class RemoteQueue:
+    def __init__(self, events: mp.Queue, job_id: int, slot: int):
+        self.events = events
+        self.job_id = job_id
+        self.slot = slot
+
+    def put(self, message: bytes):
+        self.events.put(("message", self.job_id, self.slot, None, message))
+
+    def put_latest(self, key: Hashable, message: bytes):
+        # Coalesced by the session queue in the server process
+        self.events.put(("message", self.job_id, self.slot, key, message))
+
+
+class RemoteSession:
+    def __init__(self, events: mp.Queue, job_id: int, slot: int, cancel_flags: Any, previews: bool):
+        self.queue = RemoteQueue(events, job_id, slot)
+        self.previews = previews
+        self.slot = slot
+        self.cancel_flags = cancel_flags
+        self.tasks = []
+
+    @property
+    def cancel(self) -> bool:
+        return bool(self.cancel_flags[self.slot])
+
+    @cancel.setter
+    def cancel(self, value: bool):
+        self.cancel_flags[self.slot] = int(value)
+
+
+def worker_main(
+    index: int, root_dir: Optional[str], thread_count: int, requests: mp.Queue, events: mp.Queue, cancel_flags: Any
+):
+    import torch
+
+    torch.set_num_threads(thread_count)
+    config.load_settings(root_dir)
+
+    from .control_net import ControlNetProcessor
+    from .image_generator import ImageGenerator
+
+    generator = ImageGenerator(ControlNetProcessor())
+
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+
+        job_id, entries = item
+        try:
+            items = []
+            for slot, (req_json, has_session, previews) in enumerate(entries):
+                session = RemoteSession(events, job_id, slot, cancel_flags, previews) if has_session else None
+                items.append((ImageRequest.parse_raw(req_json), session))
+
+            # Saving finishes on the writer threads, results only cross the process boundary once it has
+            results = [result.result() if isinstance(result, Future) else result for result in generator.batch(items)]
+            events.put(("metrics", index, metrics.drain()))
+            events.put(("result", job_id, results))
+        except Exception:
+            events.put(("metrics", index, metrics.drain()))
+            events.put(("error", job_id, traceback.format_exc()))
+
+
+@dataclass
+class Worker:
+    index: int
+    process: Optional[mp.Process] = None
+    requests: Optional[mp.Queue] = None
+    cancel_flags: Any = None
+    loaded: Optional[dict[str, Any]] = None
+    busy: bool = False
+    last_used: float = 0.0
+    sessions: list[Optional[Session]] = field(default_factory=list)
+
+
+@dataclass
+class PendingJob:
+    future: Future
+    worker: Worker
+    sessions: list[Optional[Session]]
+
+
+class WorkerPool:
+    def __init__(self, worker_count: int, root_dir: Optional[str], max_batch_size: int):
+        self.context = mp.get_context("spawn")
+        self.root_dir = root_dir
+        self.max_batch_size = max(1, max_batch_size)
+        self.thread_count = max(1, (os.cpu_count() or 1) // worker_count)
+        self.events = self.context.Queue()
+        self.workers = [Worker(index) for index in range(worker_count)]
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count()
+        self.pending: dict[int, PendingJob] = {}
+        self.relay_thread: Optional[threading.Thread] = None
+
+    def start(self):
+        for worker in self.workers:
+            self.spawn(worker)
+
+        self.relay_thread = threading.Thread(target=self.relay, daemon=True)
+        self.relay_thread.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+        self.events.put(None)
+        self.relay_thread.join()
+
+    def spawn(self, worker: Worker):
+        worker.requests = self.context.Queue()
+        worker.cancel_flags = self.context.Array("b", self.max_batch_size)
+        worker.loaded = None
+        metrics.forget(worker.index)
+        worker.process = self.context.Process(
+            target=worker_main,
+            args=(worker.index, self.root_dir, self.thread_count, worker.requests, self.events, worker.cancel_flags),
+            daemon=True,
+        )
+        worker.process.start()
+
+    def __call__(self, req: ImageRequest, session: Optional[Session]):
+        return self.batch([(req, session)])[0]
+
+    def batch(self, items: list[tuple[ImageRequest, Optional[Session]]]):
+        wanted = affinity(items[0][0])
+        sessions = [session for _, session in items]
+        future = Future()
+
+        with self.lock:
+            worker = self.select_worker(wanted)
+            worker.busy = True
+            worker.loaded = wanted
+            worker.last_used = time.perf_counter()
+            worker.sessions = sessions
+
+            # A cancel requested while the job was queued applies as soon as it starts
+            for slot, session in enumerate(sessions):
+                worker.cancel_flags[slot] = int(bool(session and session.cancel))
+                if session:
+                    session.cancel = False
+
+            job_id = next(self.job_ids)
+            self.pending[job_id] = PendingJob(future, worker, sessions)
+
+        entries = [
+            (req.json(), session is not None, session is not None and session.previews) for req, session in items
+        ]
+        worker.requests.put((job_id, entries))
+
+        try:
+            while True:
+                try:
+                    return future.result(timeout=1.0)
+                except TimeoutError:
+                    if not worker.process.is_alive():
+                        print("Worker process", worker.index, "exited, restarting")
+                        self.spawn(worker)
+                        raise RuntimeError("Worker process exited")
+        finally:
+            with self.lock:
+                self.pending.pop(job_id, None)
+                worker.busy = False
+                worker.sessions = []
+
+    def select_worker(self, wanted: dict[str, Any]) -> Worker:
+        idle = [worker for worker in self.workers if not worker.busy]
+        if not idle:
+            raise RuntimeError("No idle worker process")
+        return max(idle, key=lambda worker: (affinity_score(worker.loaded, wanted), -worker.last_used))
+
+    def cancel(self, session: Session) -> bool:
+        cancelled = False
+        with self.lock:
+            for worker in self.workers:
+                for slot, worker_session in enumerate(worker.sessions):
+                    if worker_session is session:
+                        worker.cancel_flags[slot] = 1
+                        cancelled = True
+        return cancelled
+
+    def relay(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+
+            if event[0] == "metrics":
+                # Sent before the result, a scrape after the job completes includes it
+                _, index, deltas = event
+                metrics.merge(index, deltas)
+                continue
+
+            kind, job_id, *payload = event
+            with self.lock:
+                pending = self.pending.get(job_id)
+            if not pending:
+                continue
+
+            if kind == "message":
+                slot, key, message = payload
+                session = pending.sessions[slot]
+                if session and key is None:
+                    session.queue.put(message)
+                elif session:
+                    session.queue.put_latest(key, message)
+            elif kind == "result":
+                pending.future.set_result(payload[0])
+            elif kind == "error":
+                pending.future.set_exception(RuntimeError(payload[0]))
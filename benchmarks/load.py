@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+from backend import messages
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.statuses: dict[str, dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.message_counts: dict[str, int] = defaultdict(int)
+        self.message_bytes = 0
+        self.first_preview: list[float] = []
+        self.memory: list[float] = []
+
+    def record(self, operation: str, start_time: float, status: int):
+        self.statuses[operation][status] += 1
+        if status < 400:
+            self.latencies[operation].append(time.perf_counter() - start_time)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values: list[float], duration: float) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "per_second": len(values) / duration,
+        "mean_ms": sum(values) / len(values) * 1000,
+        "p50_ms": percentile(values, 0.5) * 1000,
+        "p90_ms": percentile(values, 0.9) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+async def timed_get(client, recorder: Recorder, operation: str, url: str):
+    start_time = time.perf_counter()
+    response = await client.get(url)
+    recorder.record(operation, start_time, response.status_code)
+    return response
+
+
+async def generate_session(client, base_url: str, recorder: Recorder, args, stop_time: float):
+    import websockets
+
+    ws_url = base_url.replace("http", "ws", 1) + "/ws"
+    async with websockets.connect(ws_url, max_size=None) as websocket:
+        header = await websocket.recv()
+        message_type, _ = struct.unpack(">ii", header[:8])
+        assert message_type == messages.Type.SESSION_ID
+        session_id = uuid.UUID(bytes=header[8:24])
+        submit_times: dict[uuid.UUID, float] = {}
+
+        async def read():
+            async for message in websocket:
+                message_type, _ = struct.unpack(">ii", message[:8])
+                recorder.message_counts[messages.Type(message_type).name] += 1
+                recorder.message_bytes += len(message)
+                if message_type in [messages.Type.IMAGE, messages.Type.PREVIEW]:
+                    start_time = submit_times.pop(uuid.UUID(bytes=message[8:24]), None)
+                    if start_time is not None:
+                        recorder.first_preview.append(time.perf_counter() - start_time)
+
+        reader = asyncio.create_task(read())
+        try:
+            while time.perf_counter() < stop_time:
+                generator_id = uuid.uuid4()
+                request = {
+                    "session_id": str(session_id),
+                    "generator_id": str(generator_id),
+                    "collection": "outputs",
+                    "prompt": "load test",
+                    "image_count": args.image_count,
+                }
+                start_time = time.perf_counter()
+                submit_times[generator_id] = start_time
+                response = await client.post(f"{base_url}/api/v1/sd-generate", json=request)
+                recorder.record("generate", start_time, response.status_code)
+                if response.status_code == 429:
+                    await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+        finally:
+            reader.cancel()
+
+
+async def browse(client, base_url: str, recorder: Recorder, stop_time: float):
+    # Gallery listing followed by a page of thumbnails and one full image, like scrolling the viewer
+    while time.perf_counter() < stop_time:
+        response = await timed_get(client, recorder, "gallery", f"{base_url}/api/v1/images/default/load")
+        paths = response.json() if response.status_code == 200 else []
+        if not paths:
+            await asyncio.sleep(0.1)
+            continue
+
+        page = random.randrange(max(1, len(paths) // 50))
+        for path in paths[page * 50 : page * 50 + 50]:
+            await timed_get(client, recorder, "thumbnail", f"{base_url}/thumbnails/default/{path}")
+        await timed_get(client, recorder, "image", f"{base_url}/images/default/{random.choice(paths)}")
+
+
+async def sample_memory(client, base_url: str, recorder: Recorder, stop_time: float):
+    while time.perf_counter() < stop_time:
+        response = await client.get(f"{base_url}/metrics")
+        match = re.search(r"^seed_alchemy_process_resident_memory_bytes (\S+)$", response.text, re.MULTILINE)
+        if match:
+            recorder.memory.append(float(match.group(1)))
+        await asyncio.sleep(1.0)
+
+
+async def wait_for_server(client, base_url: str, server, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while True:
+        if server and server.poll() is not None:
+            raise RuntimeError("Stub server exited")
+        try:
+            response = await client.get(f"{base_url}/api/v1/users")
+            if response.status_code == 200:
+                return
+        except Exception:
+            if time.perf_counter() > deadline:
+                raise
+        await asyncio.sleep(0.5)
+
+
+async def run(base_url: str, server, args) -> dict:
+    import httpx
+
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.sessions + args.browsers + 1)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        await wait_for_server(client, base_url, server, 60.0)
+
+        start_time = time.perf_counter()
+        stop_time = start_time + args.duration
+        await asyncio.gather(
+            sample_memory(client, base_url, recorder, stop_time),
+            *[generate_session(client, base_url, recorder, args, stop_time) for _ in range(args.sessions)],
+            *[browse(client, base_url, recorder, stop_time) for _ in range(args.browsers)],
+        )
+        duration = time.perf_counter() - start_time
+
+    return {
+        "duration": duration,
+        "operations": {
+            operation: {**summarize(recorder.latencies[operation], duration), "statuses": dict(statuses)}
+            for operation, statuses in recorder.statuses.items()
+        },
+        "first_preview": summarize(recorder.first_preview, duration),
+        "websocket": {
+            "messages": dict(recorder.message_counts),
+            "messages_per_second": sum(recorder.message_counts.values()) / duration,
+            "bytes_per_second": recorder.message_bytes / duration,
+        },
+        "server_memory": {
+            "start_bytes": recorder.memory[0] if recorder.memory else None,
+            "peak_bytes": max(recorder.memory) if recorder.memory else None,
+            "end_bytes": recorder.memory[-1] if recorder.memory else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the HTTP and websocket layer with a stub generator")
+    parser.add_argument("--url", default=None, help="Test an already running stub server instead of starting one")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--sessions", type=int, default=32, help="Concurrent websocket sessions generating images")
+    parser.add_argument("--browsers", type=int, default=8, help="Concurrent gallery and thumbnail clients")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--image-count", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=1.0, help="Stub seconds per generate call")
+    parser.add_argument("--preview-fps", type=float, default=10.0)
+    parser.add_argument("--preview-size", type=int, default=64)
+    parser.add_argument("--gallery-size", type=int, default=500)
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    server = None
+    root = None
+    base_url = args.url
+    if not base_url:
+        root = tempfile.mkdtemp(prefix="seed-alchemy-load-")
+        base_url = f"http://127.0.0.1:{args.port}"
+        # Plenty of admission headroom, rejections would measure the limits rather than the server
+        env = {**os.environ, "MAX_QUEUE_DEPTH": "0", "MAX_USER_QUEUE_DEPTH": "0"}
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.stub_server",
+                "--root",
+                root,
+                "--port",
+                str(args.port),
+                "--latency",
+                str(args.latency),
+                "--preview-fps",
+                str(args.preview_fps),
+                "--preview-size",
+                str(args.preview_size),
+                "--gallery-size",
+                str(args.gallery_size),
+            ],
+            env=env,
+        )
+
+    try:
+        results = asyncio.run(run(base_url, server, args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(root, ignore_errors=True)
+
+    results["settings"] = {key: value for key, value in vars(args).items() if key not in ["url", "output"]}
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
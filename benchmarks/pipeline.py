@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Hashable
+
+# Offline and on CPU, results should only depend on the code under test
+os.environ["DISABLE_TELEMETRY"] = "1"
+os.environ["HF_HUB_OFFLINE"] = "1"
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import torch
+from PIL import Image
+
+from backend import config, metrics
+from backend.models import ImageRequest
+
+from .tiny_models import register_models
+
+SCENARIOS = {
+    "sd1-txt2img": {"model": "tiny-sd-1"},
+    "sd1-lora": {"model": "tiny-sd-1", "lora": {"entries": [{"model": "tiny-lora-sd-1", "weight": 0.5}]}},
+    "sd1-controlnet": {
+        "model": "tiny-sd-1",
+        "control_net": {"conditions": [{"model": "tiny-controlnet-sd-1", "source": "benchmark/condition.png"}]},
+    },
+    "sdxl-txt2img": {"model": "tiny-sdxl"},
+}
+
+
+class CollectingQueue:
+    # Stands in for the websocket queue so previews are encoded like a live session
+    def __init__(self):
+        self.message_count = 0
+        self.byte_count = 0
+
+    def put(self, message: bytes):
+        self.message_count += 1
+        self.byte_count += len(message)
+
+    def put_latest(self, key: Hashable, message: bytes):
+        self.put(message)
+
+
+def stage_totals() -> dict[str, tuple[int, float]]:
+    with metrics.stage_seconds.lock:
+        return {
+            key[0]: (sum(counts), metrics.stage_seconds.sums[key])
+            for key, counts in metrics.stage_seconds.counts.items()
+        }
+
+
+def stage_deltas(before: dict[str, tuple[int, float]], after: dict[str, tuple[int, float]], runs: int):
+    stages = {}
+    for name, (count, total) in after.items():
+        previous_count, previous_total = before.get(name, (0, 0.0))
+        if count > previous_count:
+            stages[name] = {
+                "count": count - previous_count,
+                "seconds_per_request": (total - previous_total) / runs,
+            }
+    return stages
+
+
+def run_scenario(generator, name: str, args) -> dict:
+    from backend.session import Session
+
+    params = {
+        "user": "default",
+        "collection": "benchmark",
+        "safety_checker": False,
+        "prompt": "a red fox in the snow, highly detailed",
+        "negative_prompt": "blurry",
+        "steps": args.steps,
+        "width": args.size,
+        "height": args.size,
+        "image_count": args.image_count,
+        "preview": None if args.no_preview else "latent",
+        **SCENARIOS[name],
+    }
+
+    def generate(seed: int, queue: CollectingQueue):
+        req = ImageRequest(**params, seed=seed, generator_id=uuid.uuid4())
+        session = None if args.no_preview else Session(queue=queue, cancel=False, tasks=[])
+        result = generator(req, session)
+        # Include the asynchronous image writes in the request time
+        return result.result() if isinstance(result, Future) else result
+
+    # The first run pays for model loading, it is reported separately
+    start_time = time.perf_counter()
+    generate(0, CollectingQueue())
+    warmup_seconds = time.perf_counter() - start_time
+
+    queue = CollectingQueue()
+    before = stage_totals()
+    durations = []
+    for repeat in range(args.repeats):
+        start_time = time.perf_counter()
+        generate(repeat + 1, queue)
+        durations.append(time.perf_counter() - start_time)
+    after = stage_totals()
+
+    total = sum(durations)
+    return {
+        "warmup_seconds": warmup_seconds,
+        "runs": args.repeats,
+        "seconds_per_request": {
+            "mean": total / len(durations),
+            "min": min(durations),
+            "max": max(durations),
+        },
+        "images_per_second": args.repeats * args.image_count / total,
+        "steps_per_second": args.repeats * args.steps / total,
+        "stages": stage_deltas(before, after, args.repeats),
+        "preview_messages": queue.message_count,
+        "preview_bytes": queue.byte_count,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict):
+    for name, scenario in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous:
+            ratio = scenario["images_per_second"] / previous["images_per_second"]
+            print(f"{name}: {scenario['images_per_second']:.3f} images/s ({ratio:.2f}x baseline)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end ImageGenerator benchmark on tiny random-weight models")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS.keys()), default=list(SCENARIOS.keys()))
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--image-count", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--no-preview", action="store_true", help="Skip preview encoding in the step callback")
+    parser.add_argument("--root", default=None, help="Working directory, defaults to a temporary directory")
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", default=None, help="Previous JSON report to compare images/s against")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    root = args.root or tempfile.mkdtemp(prefix="seed-alchemy-benchmark-")
+    try:
+        config.load_settings(root)
+        config.settings.cache_path = os.path.join(root, "cache")
+        config.settings.storage_path = os.path.join(root, "storage")
+
+        start_time = time.perf_counter()
+        register_models(os.path.join(root, "models"))
+        build_seconds = time.perf_counter() - start_time
+
+        condition_path = config.get_image_path("default", "benchmark/condition.png")
+        os.makedirs(os.path.dirname(condition_path), exist_ok=True)
+        Image.effect_mandelbrot((args.size, args.size), (-2.0, -1.5, 1.0, 1.5), 100).convert("RGB").save(
+            condition_path
+        )
+
+        from backend.control_net import ControlNetProcessor
+        from backend.image_generator import ImageGenerator
+
+        generator = ImageGenerator(ControlNetProcessor())
+        scenarios = {}
+        for name in args.scenarios:
+            print("Running", name, file=sys.stderr)
+            scenarios[name] = run_scenario(generator, name, args)
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    import diffusers
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "diffusers": diffusers.__version__,
+        "threads": torch.get_num_threads(),
+        "settings": {
+            "steps": args.steps,
+            "size": args.size,
+            "image_count": args.image_count,
+            "repeats": args.repeats,
+            "preview": not args.no_preview,
+            "preview_max_fps": config.settings.preview_max_fps,
+        },
+        "build_seconds": build_seconds,
+        "scenarios": scenarios,
+    }
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
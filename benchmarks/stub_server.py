@@ -0,0 +1,111 @@
+import argparse
+import io
+import os
+import sys
+import time
+from typing import Optional
+
+from PIL import Image
+
+from backend import config, messages, utils
+from backend.models import ImageRequest
+from backend.session import CancelException, Session
+
+
+def random_image(size: int, format: str, **params) -> bytes:
+    # Noise does not compress, so the payload is close to the worst case for its size
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffered = io.BytesIO()
+    image.save(buffered, format=format, **params)
+    return buffered.getvalue()
+
+
+class StubGenerator:
+    # Same interface and session messages as ImageGenerator, with a fixed latency instead of diffusion
+    def __init__(self, latency: float, preview_fps: float, preview_size: int, output_size: int):
+        self.latency = latency
+        self.frame_count = max(1, int(latency * preview_fps)) if preview_fps > 0 else 0
+        self.preview_data = random_image(preview_size, "webp", quality=config.settings.preview_quality)
+        self.output_data = random_image(output_size, "png")
+
+    def __call__(self, req: ImageRequest, session: Optional[Session]):
+        return self.batch([(req, session)])[0]
+
+    def batch(self, items: list[tuple[ImageRequest, Optional[Session]]]):
+        cancelled = [False] * len(items)
+        if self.frame_count:
+            for frame in range(self.frame_count):
+                time.sleep(self.latency / self.frame_count)
+                for index, (req, session) in enumerate(items):
+                    if not session or cancelled[index]:
+                        continue
+                    if session.cancel:
+                        session.cancel = False
+                        cancelled[index] = True
+                        continue
+                    progress_amount = int((frame + 1) * 100 / self.frame_count)
+                    session.queue.put_latest(
+                        (messages.Type.PROGRESS, req.generator_id),
+                        messages.build_progress(req.generator_id, progress_amount),
+                    )
+                    session.queue.put_latest(
+                        (messages.Type.PREVIEW, req.generator_id),
+                        messages.build_preview(req.generator_id, req.width, req.height, self.preview_data),
+                    )
+        else:
+            time.sleep(self.latency)
+
+        results = []
+        for index, (req, session) in enumerate(items):
+            if cancelled[index]:
+                results.append([])
+                continue
+
+            output_paths = []
+            for _ in range(req.image_count):
+                output_path = config.generate_output_path(req.user, req.collection)
+                with open(config.get_image_path(req.user, output_path), "wb") as f:
+                    f.write(self.output_data)
+                output_paths.append(utils.normalize_path(output_path))
+            results.append(output_paths)
+
+        if all(cancelled):
+            raise CancelException()
+        return results
+
+
+def seed_gallery(user: str, collection: str, count: int, size: int):
+    image_data = random_image(size, "png")
+    for _ in range(count):
+        output_path = config.generate_output_path(user, collection)
+        with open(config.get_image_path(user, output_path), "wb") as f:
+            f.write(image_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed Alchemy server with a stub image generator")
+    parser.add_argument("--root", type=str, required=True)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds per generate call")
+    parser.add_argument("--preview-fps", type=float, default=10.0)
+    parser.add_argument("--preview-size", type=int, default=64)
+    parser.add_argument("--output-size", type=int, default=512)
+    parser.add_argument("--gallery-size", type=int, default=500)
+    args = parser.parse_args()
+
+    # main.py parses the command line and loads settings on import
+    sys.argv = [sys.argv[0], "--root", args.root]
+    from backend import main as server
+
+    seed_gallery("default", "load", args.gallery_size, args.output_size)
+
+    stub = StubGenerator(args.latency, args.preview_fps, args.preview_size, args.output_size)
+    server.app.dependency_overrides[server.image_generator] = lambda: stub
+
+    import uvicorn
+
+    uvicorn.run(server.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
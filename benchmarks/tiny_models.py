@@ -0,0 +1,196 @@
+import json
+import os
+
+import torch
+from safetensors.torch import save_file
+
+from backend import config
+from backend.types import BaseModelType, ModelInfo, ModelType
+
+# Small enough to run a full pipeline on CPU in well under a second per step
+TEXT_HIDDEN_SIZE = 32
+UNET_BLOCK_CHANNELS = (32, 64)
+VAE_BLOCK_CHANNELS = (32, 32, 32, 32)  # 4 blocks keep the usual 8x latent scale factor
+LORA_RANK = 4
+
+
+def write_tokenizer_files(path: str):
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    # Byte-level vocabulary without merges, every prompt still tokenizes
+    os.makedirs(path, exist_ok=True)
+    symbols = list(bytes_to_unicode().values())
+    tokens = symbols + [symbol + "</w>" for symbol in symbols] + ["<|startoftext|>", "<|endoftext|>"]
+    with open(os.path.join(path, "vocab.json"), "w") as f:
+        json.dump({token: index for index, token in enumerate(tokens)}, f)
+    with open(os.path.join(path, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+
+
+def build_tokenizer(path: str, pad_token: str = "<|endoftext|>"):
+    from transformers import CLIPTokenizer
+
+    files_path = os.path.join(path, "tokenizer_files")
+    write_tokenizer_files(files_path)
+    return CLIPTokenizer(
+        os.path.join(files_path, "vocab.json"),
+        os.path.join(files_path, "merges.txt"),
+        pad_token=pad_token,
+        model_max_length=77,
+    )
+
+
+def build_text_encoder(tokenizer, with_projection: bool = False):
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection
+
+    text_config = CLIPTextConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=TEXT_HIDDEN_SIZE,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        projection_dim=TEXT_HIDDEN_SIZE,
+        max_position_embeddings=77,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    if with_projection:
+        return CLIPTextModelWithProjection(text_config)
+    return CLIPTextModel(text_config)
+
+
+def build_vae():
+    from diffusers import AutoencoderKL
+
+    return AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * len(VAE_BLOCK_CHANNELS),
+        up_block_types=["UpDecoderBlock2D"] * len(VAE_BLOCK_CHANNELS),
+        block_out_channels=VAE_BLOCK_CHANNELS,
+        layers_per_block=1,
+        latent_channels=4,
+        sample_size=64,
+    )
+
+
+def build_scheduler():
+    from diffusers import EulerDiscreteScheduler
+
+    return EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+
+
+def build_sd1(path: str):
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel
+
+    torch.manual_seed(0)
+    tokenizer = build_tokenizer(path)
+    unet = UNet2DConditionModel(
+        sample_size=8,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        block_out_channels=UNET_BLOCK_CHANNELS,
+        layers_per_block=1,
+        cross_attention_dim=TEXT_HIDDEN_SIZE,
+        attention_head_dim=4,
+    )
+    pipe = StableDiffusionPipeline(
+        vae=build_vae(),
+        text_encoder=build_text_encoder(tokenizer),
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=build_scheduler(),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipe.save_pretrained(path)
+    return pipe
+
+
+def build_sdxl(path: str):
+    from diffusers import StableDiffusionXLPipeline, UNet2DConditionModel
+
+    torch.manual_seed(0)
+    tokenizer = build_tokenizer(path)
+    tokenizer_2 = build_tokenizer(path, pad_token="!")
+    text_encoder = build_text_encoder(tokenizer)
+    text_encoder_2 = build_text_encoder(tokenizer_2, with_projection=True)
+    unet = UNet2DConditionModel(
+        sample_size=8,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        block_out_channels=UNET_BLOCK_CHANNELS,
+        layers_per_block=1,
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        # Pooled text embeddings plus 6 micro-conditioning time ids
+        projection_class_embeddings_input_dim=TEXT_HIDDEN_SIZE + 6 * 8,
+        cross_attention_dim=TEXT_HIDDEN_SIZE * 2,
+    )
+    pipe = StableDiffusionXLPipeline(
+        vae=build_vae(),
+        text_encoder=text_encoder,
+        text_encoder_2=text_encoder_2,
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer_2,
+        unet=unet,
+        scheduler=build_scheduler(),
+    )
+    pipe.save_pretrained(path)
+    return pipe
+
+
+def build_controlnet(path: str, unet):
+    from diffusers import ControlNetModel
+
+    torch.manual_seed(1)
+    control_net = ControlNetModel.from_unet(unet, load_weights_from_unet=False)
+    control_net.save_pretrained(path)
+
+
+def build_lora(path: str, unet):
+    # Kohya style keys for every attention projection, the format lora.load() expects
+    torch.manual_seed(2)
+    state_dict = {}
+    for name, module in unet.named_modules():
+        if isinstance(module, torch.nn.Linear) and name.split(".")[-1] in ["to_q", "to_k", "to_v"]:
+            layer = "lora_unet_" + name.replace(".", "_")
+            state_dict[f"{layer}.lora_down.weight"] = torch.randn(LORA_RANK, module.in_features) * 0.01
+            state_dict[f"{layer}.lora_up.weight"] = torch.randn(module.out_features, LORA_RANK) * 0.01
+            state_dict[f"{layer}.alpha"] = torch.tensor(float(LORA_RANK))
+    save_file(state_dict, path)
+
+
+def create_models(root: str) -> dict[str, ModelInfo]:
+    sd1_path = os.path.join(root, "tiny-sd-1")
+    sdxl_path = os.path.join(root, "tiny-sdxl")
+    control_net_path = os.path.join(root, "tiny-controlnet-sd-1")
+    lora_path = os.path.join(root, "tiny-lora-sd-1.safetensors")
+
+    sd1 = build_sd1(sd1_path)
+    build_sdxl(sdxl_path)
+    build_controlnet(control_net_path, sd1.unet)
+    build_lora(lora_path, sd1.unet)
+
+    # Diffusers folders go through the from_pretrained() branch, local means a single checkpoint file
+    return {
+        "tiny-sd-1": ModelInfo(path=sd1_path, local=False, type=ModelType.Checkpoint, base=BaseModelType.SD_1),
+        "tiny-sdxl": ModelInfo(path=sdxl_path, local=False, type=ModelType.Checkpoint, base=BaseModelType.SDXL),
+        "tiny-controlnet-sd-1": ModelInfo(
+            path=control_net_path, local=False, type=ModelType.ControlNet, base=BaseModelType.SD_1
+        ),
+        "tiny-lora-sd-1": ModelInfo(path=lora_path, local=True, type=ModelType.Lora, base=BaseModelType.SD_1),
+    }
+
+
+def register_models(root: str):
+    config.models.clear()
+    config.models.update(create_models(root))
@@ -11,12 +11,12 @@ export const ImageViewer = () => {
   const queryImages = useImages(snapSettings.collection);
   const imagePath = queryImages.data?.[snapSession.selectedIndex ?? -1] ?? null;
 
-  const imageUrl =
-    snapSettings.showPreview && snapSession.previewUrl && snapSession.generatorId == null
-      ? snapSession.previewUrl
-      : imagePath
-      ? `images/${snapSystem.user}/${imagePath}`
-      : null;
+  const showPreview = snapSettings.showPreview && snapSession.previewUrl && snapSession.generatorId == null;
+  const imageUrl = showPreview ? snapSession.previewUrl : imagePath ? `images/${snapSystem.user}/${imagePath}` : null;
+  const previewSize =
+    showPreview && snapSession.previewWidth > 0
+      ? { width: snapSession.previewWidth, height: snapSession.previewHeight }
+      : {};
 
   return (
     <div className="flex w-full h-full flex-shrink bg-black ">
@@ -25,7 +25,7 @@ export const ImageViewer = () => {
         <div className="relative w-full h-full">
           {imageUrl && (
             <div className="absolute flex w-full h-full items-center justify-center">
-              <img className="max-h-full max-w-full select-none" src={imageUrl} />
+              <img className="max-h-full max-w-full object-contain select-none" src={imageUrl} {...previewSize} />
             </div>
           )}
           {snapSettings.showMetadata && (
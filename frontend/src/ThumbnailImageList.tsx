@@ -74,7 +74,8 @@ export const ThumbnailImageList = () => {
           onContextMenu={(e) => handleContextMenu(e, index)}
         >
           <img
-            src={`thumbnails/${snapSystem.user}/${str}`}
+            src={`thumbnails/${snapSystem.user}/${str}?size=96`}
+            srcSet={`thumbnails/${snapSystem.user}/${str}?size=96 1x, thumbnails/${snapSystem.user}/${str}?size=256 2x`}
             loading="lazy"
             className="max-h-full max-w-full select-none"
           />
@@ -310,7 +310,11 @@ export class SessionState {
   selectedIndex: number = 0;
   generatorId: string | null = null;
   progressAmount: number = 0;
+  queuePosition: number = 0;
+  queueWaitMs: number = 0;
   previewUrl: string | null = null;
+  previewWidth: number = 0;
+  previewHeight: number = 0;
   historyStack: string[] = [];
   historyStackIndex: number = -1;
   promptGenResults: PromptGenResult[] = [];
@@ -1,6 +1,9 @@
 import { stringify as uuidStringify } from "uuid";
 import { useEffect } from "react";
-import { stateSession } from "./store";
+import { useQueryClient } from "react-query";
+import { addImages } from "./queries";
+import { stateSession, stateSystem } from "./store";
+import { dirName } from "./util/pathUtil";
 
 let ws: WebSocket | null = null;
 
@@ -8,20 +11,29 @@ enum MessageType {
   SESSION_ID = 1,
   PROGRESS = 2,
   IMAGE = 3,
+  QUEUE_STATUS = 4,
+  JOB_COMPLETE = 5,
+  PREVIEW = 6,
 }
 
+// Survives a page reload, so a reconnect resumes the session and its running generations
+const SESSION_ID_KEY = "seed-alchemy-session-id";
+
 function optionalUuid(bytes: Uint8Array): string | null {
   const uuid = uuidStringify(bytes);
   return uuid != "00000000-0000-0000-0000-000000000000" ? uuid : null;
 }
 
 export const WebSocketComponent = () => {
+  const queryClient = useQueryClient();
+
   const connect = () => {
     if (ws !== null) {
       return;
     }
 
-    ws = new WebSocket("ws://localhost:8000/ws");
+    const sessionId = stateSession.sessionId || sessionStorage.getItem(SESSION_ID_KEY);
+    ws = new WebSocket(`ws://localhost:8000/ws${sessionId ? `?session_id=${sessionId}` : ""}`);
     ws.binaryType = "arraybuffer";
 
     ws.onopen = () => {};
@@ -41,6 +53,7 @@ export const WebSocketComponent = () => {
       switch (type) {
         case MessageType.SESSION_ID: {
           stateSession.sessionId = uuidStringify(array.slice(8, 24));
+          sessionStorage.setItem(SESSION_ID_KEY, stateSession.sessionId);
           break;
         }
 
@@ -56,6 +69,41 @@ export const WebSocketComponent = () => {
           const blob = new Blob([new Uint8Array(event.data, 24, length - 16)]);
           const url = URL.createObjectURL(blob);
           stateSession.previewUrl = url;
+          stateSession.previewWidth = 0;
+          stateSession.previewHeight = 0;
+          break;
+        }
+
+        case MessageType.PREVIEW: {
+          // Native resolution, displayed scaled up to the final image size
+          stateSession.generatorId = optionalUuid(array.slice(8, 24));
+          stateSession.previewWidth = dataView.getInt32(24);
+          stateSession.previewHeight = dataView.getInt32(28);
+          const blob = new Blob([new Uint8Array(event.data, 32, length - 24)], { type: "image/webp" });
+          stateSession.previewUrl = URL.createObjectURL(blob);
+          break;
+        }
+
+        case MessageType.QUEUE_STATUS: {
+          stateSession.generatorId = optionalUuid(array.slice(8, 24));
+          stateSession.queuePosition = dataView.getInt32(24);
+          stateSession.queueWaitMs = dataView.getInt32(28);
+          break;
+        }
+
+        case MessageType.JOB_COMPLETE: {
+          // Results of a generation whose response was lost to a reconnect
+          const outcome = JSON.parse(new TextDecoder().decode(new Uint8Array(event.data, 24, length - 16)));
+          const imagePaths: string[] = Array.isArray(outcome.result) ? outcome.result : [];
+          const newPaths = imagePaths.filter((path) => {
+            const knownPaths = queryClient.getQueryData<string[]>(["images", stateSystem.user, dirName(path)]);
+            return !knownPaths?.includes(path);
+          });
+          if (newPaths.length > 0) {
+            addImages(queryClient, stateSystem.user, newPaths);
+          }
+          stateSession.previewUrl = null;
+          stateSession.progressAmount = 0;
           break;
         }
 